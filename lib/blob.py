@@ -155,6 +155,24 @@ class Blob(object):
         else:
             self._try_remove_split_point(tr, end) # write end needs to be merged
 
+    @fdb.transactional
+    def ingest(self, tr, offset, data):
+        """
+        Write data at offset into a region of the blob that holds no data,
+        without reading from the database or updating the size. Many
+        transactions can therefore load a new blob concurrently without
+        conflicts; the size is recorded afterwards with set_size().
+        """
+        self._write_to_sparse(tr, offset, data)
+
+    @fdb.transactional
+    def set_size(self, tr, size):
+        """
+        Record the size of the blob without changing its data. Intended for
+        blobs loaded with ingest(); use truncate() to resize other blobs.
+        """
+        self._set_size(tr, size)
+
     @fdb.transactional
     def append(self, tr, data):
         """Append the contents of data onto the end of the blob."""
@@ -15,17 +15,45 @@ for:
     - Writing SimpleDoc
     - Writing Blobs
 
+Exporter classes read data back out of the database in parallel:
+
+    - Key-value pairs to CSV
+    - SimpleDoc to JSON
+    - Blobs to files
+
 '''
 
+import bisect
+import bz2
+import collections
+import contextlib
 import csv
 import glob
+import gzip
 import json
+import multiprocessing
 import numbers
 import os
 import os.path
-
-import gevent
-from gevent.queue import Queue, Empty
+import random
+import re
+import sys
+import threading
+import time
+from Queue import Empty, Full
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 import blob
 import fdb
@@ -35,59 +63,943 @@ from subspace import Subspace
 
 fdb.api_version(100)
 
-db = fdb.open(event_model="gevent")
+# Number of commit latencies kept for percentiles
+LATENCY_SAMPLES = 10000
+
+# Default size of the byte ranges into which large input files are divided
+SPLIT_BYTES = 1 << 23
+
+# Number of CSV rows converted together when a schema is given
+PARSE_BLOCK_ROWS = 1000
+
+# Number of items a parsing process sends back at a time, and the number of
+# such chunks that may wait for each unit of work
+PARSE_CHUNK_ITEMS = 1000
+PARSE_CHUNKS_QUEUED = 4
 
 @fdb.transactional
 def clear_subspace(tr, subspace):
     tr.clear_range_startswith(subspace.key())
 
+# Returns the sorted keys strictly inside [begin, end) at which the cluster's
+# shards begin, together with any of the extra keys in that range.
+def _boundary_keys(db, begin, end, extra=()):
+    keys = set(k for k in extra if begin < k < end)
+    locality = getattr(fdb, 'locality', None)
+    if locality is not None:
+        keys.update(k for k in locality.get_boundary_keys(db, begin, end) if begin < k < end)
+    return sorted(keys)
+
+@fdb.transactional
+def _subspace_empty(tr, subspace):
+    for _ in tr.get_range_startswith(subspace.key(), limit=1):
+        return False
+    return True
+
+# Checkpoints record, for each unit of work, the batches already committed as
+# checkpoint['batch'][unit key][first item] = packed (first, end) item ranges,
+# and units that are completely loaded as checkpoint['done'][unit key].
+
+@fdb.transactional
+def _committed_batches(tr, checkpoint, unit_key):
+    if tr[checkpoint['done'].pack(unit_key)].present():
+        return None
+    ranges = []
+    for k, v in tr[checkpoint['batch'].range(unit_key)]:
+        flat = fdb.tuple.unpack(v)
+        ranges.extend(zip(flat[::2], flat[1::2]))
+    return sorted(ranges)
+
+@fdb.transactional
+def _complete_unit(tr, checkpoint, unit_key):
+    del tr[checkpoint['batch'].range(unit_key)]
+    tr[checkpoint['done'].pack(unit_key)] = ''
+
+##########################
+## Concurrency backends ##
+##########################
+
+class GeventBackend(object):
+    '''
+    Runs tasks as gevent greenlets. The database is opened with the gevent
+    event model, so that waiting for it lets other greenlets run. gevent is
+    imported only when this backend is used.
+    '''
+    event_model = 'gevent'
+
+    def __init__(self):
+        import gevent
+        import gevent.event
+        import gevent.lock
+        import gevent.queue
+        self._gevent = gevent
+
+    def spawn(self, function, *args):
+        return self._gevent.spawn(function, *args)
+
+    def join(self, tasks):
+        self._gevent.joinall(tasks)
+
+    def kill(self, tasks):
+        self._gevent.killall(tasks)
+
+    def queue(self, maxsize=0):
+        return self._gevent.queue.Queue(maxsize=maxsize)
+
+    def event(self):
+        return self._gevent.event.Event()
+
+    def lock(self):
+        return self._gevent.lock.Semaphore()
+
+    def sleep(self, seconds):
+        self._gevent.sleep(seconds)
+
+    # Runs a function that blocks the OS thread without blocking other greenlets
+    def run_blocking(self, function, *args):
+        return self._gevent.get_hub().threadpool.apply(function, args)
+
+
+class _Thread(threading.Thread):
+    # A daemon thread with the parts of the greenlet interface used here
+    def __init__(self, function, args):
+        super(_Thread, self).__init__()
+        self.daemon = True
+        self._function = function
+        self._args = args
+        self.exception = None
+
+    def run(self):
+        try:
+            self._function(*self._args)
+        except Exception as e:
+            self.exception = e
+
+    @property
+    def dead(self):
+        return not self.is_alive()
+
+
+class ThreadBackend(object):
+    '''
+    Runs tasks as OS threads, for embedding in threaded programs. The database
+    is opened with the default event model. Threads cannot be killed, so
+    kill() waits for tasks to notice that the run has stopped.
+    '''
+    event_model = None
+
+    def spawn(self, function, *args):
+        thread = _Thread(function, args)
+        thread.start()
+        return thread
+
+    def join(self, tasks):
+        for t in tasks: t.join()
+
+    def kill(self, tasks):
+        self.join(tasks)
+
+    def queue(self, maxsize=0):
+        import Queue
+        return Queue.Queue(maxsize=maxsize)
+
+    def event(self):
+        return threading.Event()
+
+    def lock(self):
+        return threading.Lock()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def run_blocking(self, function, *args):
+        return function(*args)
+
+
+BACKENDS = {'gevent': GeventBackend, 'thread': ThreadBackend}
+
+_database = None
+_database_event_model = None
+_database_lock = threading.Lock()
+
+# Opens the default database the first time it is needed. The event model of
+# the FoundationDB client can be chosen only once per process, so a backend
+# needing another event model cannot use it.
+def _open_database(backend):
+    global _database, _database_event_model
+    with _database_lock:
+        if _database is None:
+            _database = fdb.open(event_model=backend.event_model)
+            _database_event_model = backend.event_model
+        elif backend.event_model != _database_event_model:
+            raise Exception('The database was opened with event model %r, which %s cannot use'
+                            % (_database_event_model, type(backend).__name__))
+        return _database
+
+
+class _BulkBase(object):
+    # Holds the concurrency backend and database shared by loaders and
+    # exporters.
+    def __init__(self, **kwargs):
+        backend = kwargs.get('backend', 'gevent')
+        if isinstance(backend, basestring):
+            backend = BACKENDS[backend]()
+        self._backend = backend
+        self._db = kwargs.get('db', None)
+        self._stopping = False
+
+    @property
+    def db(self):
+        '''The database, opened on first use unless one was given.'''
+        if self._db is None:
+            self._db = _open_database(self._backend)
+        return self._db
+
+
 ##############################
 ## Base class for the layer ##
 ##############################
 
-class BulkLoader(Queue):
+class LoadStats(object):
+    '''
+    Statistics of a single run of BulkLoader.produce_and_consume(). Idle times
+    are summed over all tasks of a stage: producers are idle while waiting for
+    room in the queue, and consumers are idle while waiting for data.
+    '''
+    def __init__(self, number_producers, number_consumers):
+        self._lock = threading.Lock()
+        self.number_producers = number_producers
+        self.number_consumers = number_consumers
+        self.start_time = time.time()
+        self.end_time = None
+        self.producer_idle = 0.0
+        self.consumer_idle = 0.0
+        self.queue_samples = 0
+        self.queue_depth_sum = 0
+        self.max_queue_depth = 0
+        self.queue_depth = 0  # At the latest sample
+        self.items_read = 0  # Queued for writing
+        self.in_flight = 0  # Transactions being written
+        self.commits = 0
+        self.items_written = 0
+        self.items_skipped = 0  # Left unchanged by an upsert
+        self.bytes_written = 0
+        self.retries = 0
+        self.conflicts = 0
+        self.latency_sum = 0.0
+        self.latencies = []  # A uniform sample of commit latencies
+
+    def record_commit(self, items, size, latency, skipped=0):
+        with self._lock:
+            self.commits += 1
+            self.items_written += items
+            self.items_skipped += skipped
+            self.bytes_written += size
+            self.latency_sum += latency
+            # Reservoir sampling keeps memory bounded on long loads
+            if len(self.latencies) < LATENCY_SAMPLES:
+                self.latencies.append(latency)
+            else:
+                i = random.randrange(self.commits)
+                if i < LATENCY_SAMPLES: self.latencies[i] = latency
+
+    def record_retry(self, code):
+        with self._lock:
+            self.retries += 1
+            if code == 1020: self.conflicts += 1
+
+    def record_idle(self, producer, seconds):
+        with self._lock:
+            if producer:
+                self.producer_idle += seconds
+            else:
+                self.consumer_idle += seconds
+
+    def record_read(self, items):
+        with self._lock:
+            self.items_read += items
+
+    def record_in_flight(self, change):
+        with self._lock:
+            self.in_flight += change
+
+    def sample_queue(self, depth):
+        with self._lock:
+            self.queue_samples += 1
+            self.queue_depth_sum += depth
+            self.queue_depth = depth
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def report(self):
+        '''
+        Returns a dictionary summarizing the run. A load whose consumers are
+        idle a larger fraction of the time than its producers is bound by the
+        reader; otherwise it is bound by the writer.
+        '''
+        elapsed = max(self.elapsed(), 1e-9)
+        producer_idle = self.producer_idle / (elapsed * self.number_producers)
+        consumer_idle = self.consumer_idle / (elapsed * self.number_consumers)
+        return {
+            'elapsed': elapsed,
+            'producer_idle_fraction': producer_idle,
+            'consumer_idle_fraction': consumer_idle,
+            'average_queue_depth': float(self.queue_depth_sum) / max(self.queue_samples, 1),
+            'max_queue_depth': self.max_queue_depth,
+            'bound_by': 'reader' if consumer_idle > producer_idle else 'writer',
+            'commits': self.commits,
+            'items_written': self.items_written,
+            'items_skipped': self.items_skipped,
+            'bytes_written': self.bytes_written,
+            'items_per_second': (self.items_written + self.items_skipped) / elapsed,
+            'bytes_per_second': self.bytes_written / elapsed,
+            'retries': self.retries,
+            'conflicts': self.conflicts,
+            'commit_latency': _percentiles(self.latencies),
+        }
+
+    def progress(self):
+        '''
+        Returns a dictionary of the live counters of the run, which is cheap
+        enough to call while it is in progress.
+        '''
+        elapsed = max(self.elapsed(), 1e-9)
+        return {
+            'elapsed': elapsed,
+            'items_read': self.items_read,
+            'items_written': self.items_written,
+            'items_skipped': self.items_skipped,
+            'bytes_written': self.bytes_written,
+            'commits': self.commits,
+            'retries': self.retries,
+            'conflicts': self.conflicts,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'items_per_second': (self.items_written + self.items_skipped) / elapsed,
+            'bytes_per_second': self.bytes_written / elapsed,
+        }
+
+    def progress_line(self):
+        '''Returns the live counters as a single line of text.'''
+        p = self.progress()
+        return ('%(elapsed).0fs read %(items_read)d written %(items_written)d '
+                'skipped %(items_skipped)d (%(items_per_second).0f items/s, '
+                '%(bytes_per_second).0f B/s) in flight %(in_flight)d '
+                'queue %(queue_depth)d retries %(retries)d conflicts %(conflicts)d' % p)
+
+    def summary(self):
+        '''Returns a multi-line description of the finished run.'''
+        r = self.report()
+        latency = r['commit_latency']
+        lines = [
+            'elapsed       %.1f s, bound by the %s' % (r['elapsed'], r['bound_by']),
+            'items         %d written, %d skipped, %.0f items/s' %
+                (r['items_written'], r['items_skipped'], r['items_per_second']),
+            'bytes         %d written, %.0f B/s' % (r['bytes_written'], r['bytes_per_second']),
+            'commits       %d, %d retries, %d conflicts' %
+                (r['commits'], r['retries'], r['conflicts']),
+            'idle          producers %.0f%%, consumers %.0f%%' %
+                (100 * r['producer_idle_fraction'], 100 * r['consumer_idle_fraction']),
+            'queue depth   %.1f average, %d max' % (r['average_queue_depth'], r['max_queue_depth']),
+        ]
+        if latency:
+            lines.append('commit        p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s' %
+                         (latency['p50'], latency['p90'], latency['p99'], latency['max']))
+        return '\n'.join(lines)
+
+
+# Returns the 50th, 90th and 99th percentiles and the maximum of a list.
+def _percentiles(values):
+    values = sorted(values)
+    if not values: return {}
+    result = {'max': values[-1]}
+    for p in (50, 90, 99):
+        result['p%d' % p] = values[min(len(values) * p // 100, len(values) - 1)]
+    return result
+
+
+class AIMDController(object):
+    '''
+    Limits the number of writer transactions in flight, adjusting the limit
+    with additive increase and multiplicative decrease. Every interval seconds
+    the controller measures throughput, mean commit latency and the fraction of
+    attempts that had to be retried:
+
+        - if latency exceeds max_latency or the retry rate exceeds
+          max_retry_rate, the limit is multiplied by decrease;
+        - if the previous step increased the limit and throughput fell, the
+          increase is reverted;
+        - otherwise the limit grows by increase.
+
+    The limit always stays within [minimum, maximum]. Each decision is appended
+    to the trace list as a dictionary.
+    '''
+    def __init__(self, backend, initial, minimum=1, maximum=100, interval=1.0,
+                 increase=1, decrease=0.5, max_latency=1.0, max_retry_rate=0.1):
+        self._backend = backend
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial, minimum), maximum)
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.max_latency = max_latency
+        self.max_retry_rate = max_retry_rate
+        self.in_flight = 0
+        self.trace = []
+        self._lock = threading.Lock()
+        self._released = backend.event()
+        self.stopped = False
+        self._last_counts = (0, 0, 0, 0.0)
+        self._last_time = time.time()
+        self._last_action = None
+        self._last_throughput = 0.0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                self._released.clear()
+            self._released.wait()
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._released.set()
+
+    def adjust(self, stats):
+        now = time.time()
+        counts = (stats.commits, stats.items_written, stats.retries, stats.latency_sum)
+        commits, items, retries, latency_sum = [c - l for c, l in zip(counts, self._last_counts)]
+        elapsed = max(now - self._last_time, 1e-9)
+        self._last_counts = counts
+        self._last_time = now
+
+        throughput = items / elapsed
+        latency = latency_sum / commits if commits else 0.0
+        retry_rate = float(retries) / (commits + retries) if commits + retries else 0.0
+
+        if not commits and not retries:
+            action = 'idle'
+        elif latency > self.max_latency or retry_rate > self.max_retry_rate:
+            action = 'decrease'
+            self.limit = max(self.minimum, int(self.limit * self.decrease))
+        elif self._last_action == 'increase' and throughput < self._last_throughput:
+            action = 'revert'
+            self.limit = max(self.minimum, self.limit - self.increase)
+        else:
+            action = 'increase'
+            self.limit = min(self.maximum, self.limit + self.increase)
+        with self._lock:
+            self._released.set()
+
+        self._last_action = action
+        self._last_throughput = throughput
+        self.trace.append({'time': now, 'action': action, 'limit': self.limit,
+                           'throughput': throughput, 'latency': latency,
+                           'retry_rate': retry_rate})
+        return action
+
+    def run(self, stats):
+        while True:
+            self._backend.sleep(self.interval)
+            if self.stopped: return
+            self.adjust(stats)
+
+
+class Batch(list):
+    '''
+    A list of data items written by a single transaction. Records the key of the
+    unit of work the items were read from and the positions of the items within
+    it.
+    '''
+    def __init__(self, items=(), unit=(), positions=(), size=0):
+        super(Batch, self).__init__(items)
+        self.unit = unit
+        self.positions = list(positions)
+        self.size = size  # Estimated bytes
+
+    def add(self, data, position, size):
+        self.append(data)
+        self.positions.append(position)
+        self.size += size
+
+    # Returns the positions as a sorted list of (first, end) ranges.
+    def ranges(self):
+        ranges = []
+        for p in self.positions:
+            if ranges and ranges[-1][1] == p:
+                ranges[-1][1] = p + 1
+            else:
+                ranges.append([p, p + 1])
+        return [tuple(r) for r in ranges]
+
+    def split(self):
+        half = len(self) // 2
+        half_size = self.size * half // len(self)
+        return (Batch(self[:half], self.unit, self.positions[:half], half_size),
+                Batch(self[half:], self.unit, self.positions[half:], self.size - half_size))
+
+
+# Yields (position, data) for the items not covered by a sorted list of
+# (first, end) ranges.
+def _uncommitted(items, committed):
+    committed = iter(committed)
+    skip = next(committed, None)
+    for index, data in enumerate(items):
+        while skip and skip[1] <= index:
+            skip = next(committed, None)
+        if skip and skip[0] <= index: continue
+        yield index, data
+
+
+class _RoundRobin(object):
+    # Buffers batches by partition and releases them cycling over partitions.
+    def __init__(self):
+        self._batches = collections.OrderedDict()  # partition -> deque of batches
+        self.size = 0
+
+    def add(self, partition, batch):
+        self._batches.setdefault(partition, collections.deque()).append(batch)
+        self.size += 1
+
+    def take(self):
+        partition, batches = next(self._batches.iteritems())
+        batch = batches.popleft()
+        # Move the partition to the back of the rotation
+        del self._batches[partition]
+        if batches: self._batches[partition] = batches
+        self.size -= 1
+        return partition, batch
+
+
+# Marks the end of the stream of batches for a consumer
+_END = object()
+
+
+class _SharedIterator(object):
+    # Lets several tasks take items from one iterator, which may itself yield
+    # to other tasks while producing an item.
+    def __init__(self, iterable, lock):
+        self._iterator = iter(iterable)
+        self._lock = lock
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        with self._lock:
+            return next(self._iterator)
+
+
+class BulkLoader(_BulkBase):
     '''
     Supports the use of multiple concurrent transactions for efficiency, with a
     default of 50 concurrent transactions.
+
+    Data yielded by reader() is grouped into batches, each of which is written
+    by a single transaction that calls writer() once per item. Supported keyword
+    arguments for batching are:
+
+    batch_bytes=<int>. Approximate number of bytes of data to write per
+        transaction. Default is 10240.
+
+    batch_rows=<int>. Maximum number of items to write per transaction.
+        Default is 1000.
+
+    A batch that fails with transaction_too_large is split in half and each
+    half is retried separately.
+
+    The input is divided into units of work, such as files or byte ranges of
+    files, which are shared among the producers so that each unit is read once.
+
+    Producers pass batches to consumers through a bounded queue, and the end
+    of the data is signalled to each consumer explicitly. Keyword arguments for
+    the queue are:
+
+    queue_size=<int>. Maximum number of batches waiting to be written. Producers
+        block while the queue is full. Defaults to the number of consumers.
+
+    poll_interval=<float>. Seconds a blocked producer or consumer waits before
+        checking whether the load has failed. Default is 1.0.
+
+    After produce_and_consume() returns, the stats attribute holds a LoadStats
+    describing the run.
+
+    The number of transactions in flight can instead be chosen at run time by
+    an AIMDController, which is kept in the controller attribute. Keyword
+    arguments for adaptive concurrency are:
+
+    adaptive=<bool>. If True, number_consumers is the initial limit on
+        transactions in flight and is adjusted from measured commit latency,
+        retry rate and throughput. Default is False.
+
+    min_consumers=<int>. Lower bound of the limit. Default is 1.
+
+    max_consumers=<int>. Upper bound of the limit. Default is twice
+        number_consumers.
+
+    controller_interval=<float>. Seconds between adjustments. Default is 1.0.
+
+    max_latency=<float>. Mean commit latency in seconds above which the limit
+        is decreased. Default is 1.0.
+
+    max_retry_rate=<float>. Fraction of retried attempts above which the limit
+        is decreased. Default is 0.1.
+
+    Loads can be made resumable by recording progress in a checkpoint subspace.
+    Each batch records its position in the same transaction that writes it, so
+    a restarted load skips exactly the batches that were committed, even for
+    writers that are not idempotent. Keyword argument:
+
+    checkpoint=<Subspace()>. Specifies the subspace in which progress is
+        recorded. It is cleared when the load completes. While it holds progress
+        of an interrupted load, writers do not clear their destination. Default
+        is None, which disables checkpointing.
+
+    Items can be grouped into batches by the key range they are written to,
+    using the writer's destination_key() and destination_range(). The key
+    ranges are the cluster's shards within the destination range, together
+    with any split_keys. Keyword arguments for partitioning are:
+
+    partition=<string>. If 'spread', batches hold items of a single key range
+        and are queued cycling over the key ranges, so that concurrent
+        transactions are spread over the cluster. If 'cluster', each key range
+        is written by only one consumer, so that concurrent transactions write
+        disjoint keys; at most as many consumers as key ranges are then used.
+        Default is None, which batches items in arrival order.
+
+    split_keys=<list>. Additional keys at which to divide the destination,
+        useful when it has not been split into shards yet. Default is [].
+
+    partition_buffer=<int>. Number of full batches buffered by each producer in
+        'spread' mode. Default is number_consumers.
+
+    The database is opened only when it is first needed, and producers and
+    consumers run on a selectable concurrency backend. Keyword arguments are:
+
+    backend=<string or object>. 'gevent' runs producers and consumers as
+        greenlets and 'thread' runs them as threads. An object with the methods
+        of GeventBackend may also be given. Default is 'gevent'.
+
+    db=<Database>. The database to load. If not given, the default database is
+        opened with the event model of the backend. It is opened once per
+        process, so using a backend with another event model afterwards
+        raises an exception.
+
+    The statistics of a run are kept in self.stats while it is in progress.
+    Keyword arguments for reporting progress are:
+
+    progress=<function or bool>. A function is called with LoadStats.progress()
+        every progress_interval seconds and once when the load finishes. If
+        True, LoadStats.progress_line() is printed to stderr instead, followed
+        by LoadStats.summary() at the end. Default is None.
+
+    progress_interval=<float>. Seconds between progress reports. Default is
+        10.0.
     '''
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
-        # Setting maxsize to the number of consumers will make producers
-        # wait to put a task in the queue until some consumer is free
-        super(BulkLoader, self).__init__(maxsize=number_consumers)
+        super(BulkLoader, self).__init__(**kwargs)
         self._number_producers = number_producers
         self._number_consumers = number_consumers
+        self._batch_bytes = kwargs.get('batch_bytes', 10240)
+        self._batch_rows = kwargs.get('batch_rows', 1000)
+        self._queue_size = kwargs.get('queue_size', number_consumers)
+        self._poll_interval = kwargs.get('poll_interval', 1.0)
+        self._adaptive = kwargs.get('adaptive', False)
+        self._min_consumers = kwargs.get('min_consumers', 1)
+        self._max_consumers = kwargs.get('max_consumers', 2 * number_consumers)
+        self._checkpoint = kwargs.get('checkpoint', None)
+        self._progress = kwargs.get('progress', None)
+        self._progress_interval = kwargs.get('progress_interval', 10.0)
+        self._outstanding = {}  # unit key -> [batches not yet committed, fully read]
+        self._outstanding_lock = threading.Lock()
+        self._partition = kwargs.get('partition', None)
+        if self._partition not in (None, 'spread', 'cluster'):
+            raise Exception("partition must be 'spread' or 'cluster'")
+        self._partition_buffer = kwargs.get('partition_buffer', number_consumers)
+        self._boundaries = []
         self._kwargs = kwargs  # To be used by reader and writer in subclasses
-
-    def _producer(self):
-        # put will block if maxsize of queue is reached
-        for data in self.reader(): self.put(data)
-
-    def _consumer(self):
+        self.stats = None
+        self.controller = None
+
+    # Groups items into batches, skipping the items of committed batches given
+    # as a sorted list of (first, end) positions. Yields (partition, batch).
+    def _batches(self, items, unit_key=(), committed=()):
+        filling = {}  # partition -> batch being filled
+        spread = _RoundRobin() if self._partition == 'spread' else None
+        for index, data in _uncommitted(items, committed):
+            partition = self._partition_of(data)
+            size = self.data_size(data)
+            batch = filling.get(partition)
+            if batch and (batch.size + size > self._batch_bytes or
+                          len(batch) >= self._batch_rows):
+                for full in self._release(partition, batch, spread): yield full
+                batch = None
+            if batch is None:
+                batch = filling[partition] = Batch(unit=unit_key)
+            batch.add(data, index, size)
+        for partition in sorted(filling):
+            for full in self._release(partition, filling[partition], spread): yield full
+        while spread and spread.size:
+            yield spread.take()
+
+    def _release(self, partition, batch, spread):
+        if spread is None:
+            yield partition, batch
+            return
+        spread.add(partition, batch)
+        while spread.size > self._partition_buffer:
+            yield spread.take()
+
+    def _partition_of(self, data):
+        if self._partition is None or not self._boundaries: return 0
+        key = self.destination_key(data)
+        if key is None: return 0
+        return bisect.bisect_right(self._boundaries, key)
+
+    def _shard_boundaries(self):
+        destination = self.destination_range()
+        if destination is None: return sorted(self._kwargs.get('split_keys', ()))
+        return _boundary_keys(self.db, destination.start, destination.stop,
+                              self._kwargs.get('split_keys', ()))
+
+    def resuming(self):
+        '''Returns True if the checkpoint holds progress of an interrupted load.'''
+        return self._checkpoint is not None and not _subspace_empty(self.db, self._checkpoint)
+
+    # Adjusts the count of uncommitted batches of a unit, marking the unit
+    # complete once it has been read and all its batches committed.
+    def _update_outstanding(self, unit_key, change, read=False):
+        if self._checkpoint is None: return
+        with self._outstanding_lock:
+            outstanding = self._outstanding[unit_key]
+            outstanding[0] += change
+            outstanding[1] = outstanding[1] or read
+            complete = outstanding[1] and not outstanding[0]
+        if complete and (read or change < 0):
+            _complete_unit(self.db, self._checkpoint, unit_key)
+
+    # Puts an item on the queue, waiting while it is full. Returns False if
+    # every consumer has exited, in which case the item can never be taken.
+    def _put(self, queue, item, consumers):
+        start = time.time()
         try:
             while True:
-                data = self.get(block=False)
-                self.writer(db, data)
-                gevent.sleep(0)  # yield
-        except Empty: pass
+                try:
+                    queue.put(item, timeout=self._poll_interval)
+                    return True
+                except Full:
+                    if self._stopping or all(c.dead for c in consumers): return False
+        finally:
+            self.stats.record_idle(True, time.time() - start)
+
+    def _producer(self, routes, units):
+        for unit, items in units:
+            unit_key = self.unit_key(unit)
+            committed = ()
+            if self._checkpoint is not None:
+                committed = _committed_batches(self.db, self._checkpoint, unit_key)
+                if committed is None: continue  # unit already loaded
+                self._outstanding[unit_key] = [0, False]
+            for partition, batch in self._batches(items, unit_key, committed):
+                self._update_outstanding(unit_key, 1)
+                queue, queue_consumers = routes[partition % len(routes)]
+                if not self._put(queue, batch, queue_consumers): return
+                self.stats.record_read(len(batch))
+            self._update_outstanding(unit_key, 0, read=True)
+
+    def _consumer(self, queue):
+        while True:
+            start = time.time()
+            try:
+                batch = queue.get(timeout=self._poll_interval)
+            except Empty:
+                if self._stopping: return
+                continue
+            finally:
+                self.stats.record_idle(False, time.time() - start)
+            if batch is _END or self._stopping: return
+            self.stats.sample_queue(queue.qsize())
+            if self.controller: self.controller.acquire()
+            self.stats.record_in_flight(1)
+            try:
+                self._write_batch(self.db, batch)
+            finally:
+                self.stats.record_in_flight(-1)
+                if self.controller: self.controller.release()
+            self._backend.sleep(0)  # yield
+
+    # Retries are handled here rather than by @fdb.transactional so that
+    # commit latency and retries can be measured.
+    def _write_batch(self, db, batch):
+        tr = db.create_transaction()
+        start = time.time()
+        prepared = self.prepare_batch(batch)
+        if self._checkpoint is not None:
+            checkpoint_key = self._checkpoint['batch'].pack(batch.unit + (batch.positions[0],))
+        retried = False
+        skipped = 0
+        while True:
+            try:
+                if self._checkpoint is not None:
+                    # After commit_unknown_result, the batch may already be committed
+                    if retried and tr[checkpoint_key].present(): break
+                    tr[checkpoint_key] = fdb.tuple.pack(sum(batch.ranges(), ()))
+                skipped = self.write_prepared(tr, prepared) or 0
+                tr.commit().wait()
+                break
+            except fdb.FDBError as e:
+                # transaction_too_large is not retryable, so split the batch
+                if e.code == 2101 and len(batch) > 1:
+                    self._update_outstanding(batch.unit, 1)
+                    for half in batch.split():
+                        self._write_batch(db, half)
+                    return
+                tr.on_error(e.code).wait()
+                self.stats.record_retry(e.code)
+                retried = True
+        written = len(batch) - skipped
+        self.stats.record_commit(written, batch.size * written // max(len(batch), 1),
+                                 time.time() - start, skipped)
+        self._update_outstanding(batch.unit, -1)
 
     def produce_and_consume(self):
-        producers = [gevent.spawn(self._producer) for _ in xrange(self._number_producers)]
-        consumers = [gevent.spawn(self._consumer) for _ in xrange(self._number_consumers)]
-        gevent.joinall(producers)
-        gevent.joinall(consumers)
+        number_consumers = self._number_consumers
+        if self._adaptive:
+            self.controller = AIMDController(
+                self._backend, self._number_consumers, self._min_consumers, self._max_consumers,
+                self._kwargs.get('controller_interval', 1.0),
+                max_latency=self._kwargs.get('max_latency', 1.0),
+                max_retry_rate=self._kwargs.get('max_retry_rate', 0.1))
+            number_consumers = self.controller.maximum
+        if self._partition is not None: self._boundaries = self._shard_boundaries()
+        if self._partition == 'cluster':
+            # Each consumer has its own queue, so its key ranges are written
+            # by no other consumer
+            number_consumers = number_queues = min(number_consumers, len(self._boundaries) + 1)
+            queue_size = max(self._queue_size // number_queues, 1)
+        else:
+            number_queues = 1
+            queue_size = self._queue_size
+        self.stats = LoadStats(self._number_producers, number_consumers)
+        backend = self._backend
+        self._stopping = False
+        queues = [backend.queue(queue_size) for _ in xrange(number_queues)]
+        consumers = [backend.spawn(self._consumer, queues[i % number_queues])
+                     for i in xrange(number_consumers)]
+        routes = [(q, consumers[i::number_queues]) for i, q in enumerate(queues)]
+        # Producers share the units of work rather than each reading everything
+        units = _SharedIterator(self._unit_readers(), backend.lock())
+        producers = [backend.spawn(self._producer, routes, units) for _ in xrange(self._number_producers)]
+        if self.controller: control = backend.spawn(self.controller.run, self.stats)
+        if self._progress:
+            done = backend.event()
+            reporter = backend.spawn(self._report_progress, done)
+        try:
+            backend.join(producers)
+            if any(p.exception is not None for p in producers):
+                self._stopping = True
+                backend.kill(consumers)
+            else:
+                # Every batch is already queued, so consumers stop after them
+                for queue, queue_consumers in routes:
+                    for _ in queue_consumers:
+                        if not self._put(queue, _END, queue_consumers): break
+                backend.join(consumers)
+        finally:
+            if self.controller:
+                self.controller.stopped = True
+                backend.kill([control])
+            self.stats.end_time = time.time()
+            if self._progress:
+                done.set()
+                backend.join([reporter])
+        for g in producers + consumers:
+            if g.exception is not None: raise g.exception
+        self.finish()
+        if self._checkpoint is not None: clear_subspace(self.db, self._checkpoint)
+        return self.stats
+
+    def _report_progress(self, done):
+        while not done.wait(self._progress_interval):
+            self._show_progress()
+        self._show_progress()
+        if self._progress is True:
+            print >> sys.stderr, self.stats.summary()
+
+    def _show_progress(self):
+        if self._progress is True:
+            print >> sys.stderr, self.stats.progress_line()
+        else:
+            self._progress(self.stats.progress())
 
     # Interface stub to be overridden by a subclass. Method should be a
-    # generator that yields data in increments of size appropriate to be written
-    # by a single transaction.
+    # generator that yields data items; items are grouped into batches of
+    # size appropriate to be written by a single transaction.
     def reader(self):
         return (i for i in range(5))
 
-    # Interface stub to be overridden by a subclass. Method should ideally be
-    # designed to write around 10kB of data per transaction.
+    # Yields (unit, items) for each independent unit of work. Readers that can
+    # divide their input override this together with unit_key().
+    def _unit_readers(self):
+        yield None, self.reader()
+
+    # Returns a tuple identifying a unit of work in checkpoints.
+    def unit_key(self, unit):
+        return ()
+
+    # Interface stub to be overridden by a subclass. Method is called once
+    # after every batch has been written.
+    def finish(self):
+        pass
+
+    # Interface stubs to be overridden by a writer subclass to support
+    # partitioning. destination_key returns the first key written for an
+    # item, and destination_range returns a slice covering all of them.
+    def destination_key(self, data):
+        return None
+
+    def destination_range(self):
+        return None
+
+    # Interface stub to be overridden by a subclass. Method is called once per
+    # item of a batch, with every item of the batch sharing the transaction.
     @fdb.transactional
     def writer(self, tr, data):
         print "Would write", data
 
+    # May be overridden by a subclass to encode a whole batch at once. The
+    # result is computed once per batch rather than on every retry, and is
+    # passed to write_prepared() in place of calling writer() for each item.
+    # write_prepared() may return the number of items it left unchanged.
+    def prepare_batch(self, batch):
+        return batch
+
+    def write_prepared(self, tr, prepared):
+        for data in prepared:
+            self.writer(tr, data)
+
+    # Estimate of the number of bytes written for an item, used for batching.
+    # May be overridden by a subclass.
+    def data_size(self, data):
+        return _data_size(data)
+
+
+def _data_size(data):
+    if isinstance(data, basestring):
+        return len(data)
+    elif isinstance(data, dict):
+        return sum(_data_size(k) + _data_size(v) for k, v in data.iteritems())
+    elif isinstance(data, (list, tuple)):
+        return sum(_data_size(v) for v in data)
+    else:
+        return len(str(data))
+
 
 def test_loader():
     tasks = BulkLoader(1, 5)
@@ -98,16 +1010,260 @@ def test_loader():
 ## Reader classes ##
 ####################
 
-class ReadCSV(BulkLoader):
+class ReadFiles(BulkLoader):
     '''
-    Reads CSV files. Supported keyword arguments are:
+    Base class for readers of line-oriented or whole-file formats. Subclasses
+    supply parser(), which returns a picklable callable that parses a byte range
+    of a file. Supported keyword arguments are:
 
-    filename=<filename>. Specifies the csv file to read. If no filename is
-        given, then all files in the specified dir will be read.
+    filename=<filename>. Specifies the file to read. If no filename is given,
+        then all files in the specified dir will be read.
 
     dir=<path>. Specifies the directory of the file(s) to be read. Defaults to
         current working directory.
 
+    parse_processes=<int>. If greater than 0, files are parsed by a pool of
+        that many worker processes and the parsed data is streamed back to the
+        writers in chunks of PARSE_CHUNK_ITEMS items. A worker waits while
+        PARSE_CHUNKS_QUEUED chunks of its unit are waiting, so memory stays
+        bounded even for units that cannot be split. Default is 0, which
+        parses in the loading process.
+
+    split_bytes=<int>. If greater than 0, files of a splittable format that are
+        larger than split_bytes are divided at line boundaries into ranges of
+        about split_bytes, which can be read by different producers and parsed
+        by different processes. Records must not contain newlines. Default is
+        8 MB if number_producers or parse_processes is greater than 1, and 0
+        otherwise.
+
+    Files compressed with gzip, bzip2 or xz are detected from their contents
+    and decompressed as they are read. Compressed files cannot be split, so
+    each is read whole by one producer, or one worker process if
+    parse_processes is given. In the loading process, decompression runs
+    through the backend's run_blocking() so that writes continue meanwhile.
+    Reading xz files requires the lzma module, or backports.lzma on Python 2.
+    '''
+    # Whether records of the format are delimited by newlines
+    splittable = False
+
+    # May be overridden by a subclass whose format depends on the file.
+    def is_splittable(self, path):
+        return self.splittable
+
+    def __init__(self, number_producers=1, number_consumers=50, **kwargs):
+        super(ReadFiles, self).__init__(number_producers, number_consumers, **kwargs)
+        self._filename = kwargs.get('filename', '*')
+        self._dir = kwargs.get('dir', os.getcwd())
+        self._parse_processes = kwargs.get('parse_processes', 0)
+        parallel = number_producers > 1 or self._parse_processes > 1
+        self._split_bytes = kwargs.get('split_bytes', SPLIT_BYTES if parallel else 0)
+
+    # Yields (path, start, end) ranges of the input files. An end of None
+    # denotes the end of the file.
+    def _work_units(self):
+        for fully_pathed in glob.iglob(os.path.join(self._dir, self._filename)):
+            if not os.path.isfile(fully_pathed): continue
+            size = os.path.getsize(fully_pathed)
+            if (not self.is_splittable(fully_pathed) or self._split_bytes <= 0 or
+                    size <= self._split_bytes or _compression(fully_pathed)):
+                yield fully_pathed, 0, None
+                continue
+            for start in xrange(0, size, self._split_bytes):
+                yield fully_pathed, start, min(start + self._split_bytes, size)
+
+    def reader(self):
+        for unit, items in self._unit_readers():
+            for data in items: yield data
+
+    def _unit_readers(self):
+        parser = self.parser()
+        if self._parse_processes <= 0:
+            parser.run_blocking = self._backend.run_blocking
+            for unit in self._work_units():
+                yield unit, parser(*unit)
+            return
+
+        # Keep every worker busy while streaming results back in input order.
+        # Units are handed out in the order they were submitted, so the units
+        # whose queues are being drained are always those running first.
+        manager = multiprocessing.Manager()
+        pool = multiprocessing.Pool(self._parse_processes)
+        try:
+            pending = collections.deque()
+            for unit in self._work_units():
+                queue = manager.Queue(PARSE_CHUNKS_QUEUED)
+                result = pool.apply_async(_parse_in_worker, ((parser,) + unit + (queue,),))
+                pending.append((unit, queue, result))
+                if len(pending) >= 2 * self._parse_processes:
+                    unit, queue, result = pending.popleft()
+                    yield unit, self._worker_items(queue, result)
+            while pending:
+                unit, queue, result = pending.popleft()
+                yield unit, self._worker_items(queue, result)
+        finally:
+            pool.terminate()
+            manager.shutdown()
+
+    # Yields the items of a unit as its worker sends them, raising the
+    # worker's exception if it fails.
+    def _worker_items(self, queue, result):
+        while True:
+            try:
+                chunk = self._backend.run_blocking(queue.get, True, self._poll_interval)
+            except Empty:
+                if result.ready(): result.get()
+                continue
+            if chunk is None: return
+            for data in chunk: yield data
+
+    def unit_key(self, unit):
+        path, start, end = unit
+        return (os.path.abspath(path), start)
+
+    # Interface stub to be overridden by a subclass. Method should return a
+    # picklable callable taking (path, start, end) that yields the data items
+    # whose records begin in that byte range of the file. By default, each
+    # line is an item.
+    def parser(self):
+        return _LineParser()
+
+
+class _LineParser(object):
+    run_blocking = None
+
+    def __call__(self, path, start, end):
+        with _open_input(path, self.run_blocking) as f:
+            for line in _range_lines(f, start, end):
+                yield line
+
+
+# Sends the items of a unit to the loading process in chunks, ending with None.
+def _parse_in_worker(args):
+    parser, path, start, end, queue = args
+    chunk = []
+    for data in parser(path, start, end):
+        chunk.append(data)
+        if len(chunk) >= PARSE_CHUNK_ITEMS:
+            queue.put(chunk)
+            chunk = []
+    if chunk: queue.put(chunk)
+    queue.put(None)
+
+
+_MAGIC = [('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'xz')]
+
+
+# Returns the compression format of a file, or None if it is not compressed.
+def _compression(path):
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, kind in _MAGIC:
+        if head.startswith(magic): return kind
+    return None
+
+
+# Returns a file name without the extension of its compression format.
+def _uncompressed_name(path):
+    root, ext = os.path.splitext(path)
+    return root if ext.lower() in ('.gz', '.bz2', '.xz') else path
+
+
+def _call(function, *args):
+    return function(*args)
+
+
+# Opens an input file for reading, decompressing it if necessary. Compressed
+# files are read in large blocks through run_blocking.
+def _open_input(path, run_blocking=None):
+    kind = _compression(path)
+    if kind is None:
+        return open(path, 'rb')
+    if kind == 'gzip':
+        f = gzip.GzipFile(path, 'rb')
+    elif kind == 'bz2':
+        f = bz2.BZ2File(path, 'rb')
+    elif lzma is None:
+        raise Exception('Reading xz files requires the lzma or backports.lzma module')
+    else:
+        f = lzma.LZMAFile(path, 'rb')
+    return _BlockReader(f, run_blocking or _call)
+
+
+class _BlockReader(object):
+    # Serves reads and lines of a file from blocks read by run_blocking, so
+    # that a decompressing file is called once per block rather than per line.
+    def __init__(self, f, run_blocking, block_size=1 << 20):
+        self._file = f
+        self._run_blocking = run_blocking
+        self._block_size = block_size
+        self._buffer = ''
+        self._position = 0  # Offset of the next unread byte in the buffer
+        self._offset = 0    # Offset in the file of the start of the buffer
+        self._eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _fill(self):
+        block = self._run_blocking(self._file.read, self._block_size)
+        self._eof = not block
+        self._offset += self._position
+        self._buffer = self._buffer[self._position:] + block
+        self._position = 0
+
+    def read(self, size=-1):
+        parts = [self._buffer[self._position:]]
+        available = len(parts[0])
+        while not self._eof and (size < 0 or available < size):
+            block = self._run_blocking(self._file.read, max(self._block_size, size - available))
+            self._eof = not block
+            parts.append(block)
+            available += len(block)
+        self._offset += self._position
+        self._buffer = ''.join(parts)
+        self._position = len(self._buffer) if size < 0 else min(size, len(self._buffer))
+        return self._buffer[:self._position]
+
+    def readline(self):
+        searched = self._position
+        while True:
+            i = self._buffer.find('\n', searched)
+            if i >= 0 or self._eof: break
+            searched = len(self._buffer) - self._position
+            self._fill()
+        end = len(self._buffer) if i < 0 else i + 1
+        line = self._buffer[self._position:end]
+        self._position = end
+        return line
+
+    def tell(self):
+        return self._offset + self._position
+
+    def close(self):
+        self._file.close()
+
+
+# Yields the lines of an open file that begin in the byte range [start, end).
+def _range_lines(f, start, end):
+    if start > 0:
+        # The line containing byte start-1 belongs to the previous range
+        f.seek(start - 1)
+        f.readline()
+    position = f.tell()
+    while end is None or position < end:
+        line = f.readline()
+        if not line: break
+        position += len(line)
+        yield line
+
+
+class ReadCSV(ReadFiles):
+    '''
+    Reads CSV files. Supports the keyword arguments of ReadFiles, as well as:
+
     delimiter=<string>. Defaults to ','. Use '\t' for a tsv file.
 
     skip_empty=<bool>. If True, skip empty fields in csv files. Otherwise, replace empty
@@ -116,80 +1272,265 @@ class ReadCSV(BulkLoader):
     header=<bool>. If True, assume the first line of csv files consists of field
         names and skip it. Otherwise, treat the first line as data to be read.
         Default is False.
+
+    schema=<list>. The type of each column: 'int', 'float', 'bytes', 'unicode'
+        or a function converting the field string. Columns typed None are
+        dropped, and empty fields become None. Rows are converted a block at a
+        time, column by column, and every row must have one field per column.
+        Numbers are then stored as tuple-encoded numbers, which sort in
+        numeric order. WriteKVP rejects 'float' columns if the tuple layer of
+        the API version in use cannot pack floats. Default is None, which
+        yields every field as a string.
+
+    numpy=<bool>. If True, converts 'int' and 'float' columns with NumPy, which
+        must be installed. Default is True if NumPy is installed.
     '''
+    splittable = True
+
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
         super(ReadCSV, self).__init__(number_producers, number_consumers, **kwargs)
-        self._filename = kwargs.get('filename', '*')
         self._delimiter = kwargs.get('delimiter', ',')
-        self._dir = kwargs.get('dir', os.getcwd())
         self._skip_empty = kwargs.get('skip_empty', False)
         self._header = kwargs.get('header', False)
-
-    def reader(self):
-        for fully_pathed in glob.iglob(os.path.join(self._dir, self._filename)):
-            if not os.path.isfile(fully_pathed): continue
-            with open(fully_pathed, 'rb') as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=self._delimiter)
-                first_line = True
-                for line in csv_reader:
-                    if self._header and first_line:
-                        first_line = False
-                        continue
-                    if self._skip_empty:
-                        line = [v for v in line if v != '']
-                    yield tuple(line)
-
-
-class ReadJSON(BulkLoader):
+        self._schema = kwargs.get('schema', None)
+        self._numpy = kwargs.get('numpy', numpy is not None)
+        if self._numpy and numpy is None:
+            raise Exception('numpy=True requires NumPy to be installed')
+        if self._schema is not None:
+            for column in self._schema:
+                if not (column is None or callable(column) or column in _CONVERTERS):
+                    raise Exception('Unknown column type ' + repr(column))
+
+    def parser(self):
+        return _CSVParser(self._delimiter, self._skip_empty, self._header,
+                          self._schema, self._numpy)
+
+
+_CONVERTERS = {
+    'int': int,
+    'float': float,
+    'bytes': str,
+    'unicode': lambda v: v.decode('utf-8'),
+}
+
+_NUMPY_TYPES = {'int': 'int64', 'float': 'float64'}
+
+
+class _CSVParser(object):
+    run_blocking = None
+
+    def __init__(self, delimiter, skip_empty, header, schema=None, use_numpy=False):
+        self.delimiter = delimiter
+        self.skip_empty = skip_empty
+        self.header = header
+        self.schema = schema
+        self.use_numpy = use_numpy
+
+    def __call__(self, path, start, end):
+        with _open_input(path, self.run_blocking) as csv_file:
+            csv_reader = csv.reader(_range_lines(csv_file, start, end),
+                                    delimiter=self.delimiter)
+            first_line = start == 0
+            block = []
+            for line in csv_reader:
+                if self.header and first_line:
+                    first_line = False
+                    continue
+                if self.schema is not None:
+                    block.append(line)
+                    if len(block) >= PARSE_BLOCK_ROWS:
+                        for row in self._convert_block(block): yield row
+                        block = []
+                    continue
+                if self.skip_empty:
+                    line = [v for v in line if v != '']
+                yield tuple(line)
+            if block:
+                for row in self._convert_block(block): yield row
+
+    # Converts a block of rows a column at a time, which lets whole numeric
+    # columns be converted by NumPy.
+    def _convert_block(self, block):
+        width = len(self.schema)
+        for line in block:
+            if len(line) != width:
+                raise Exception('CSV row has %d fields but the schema has %d: %r'
+                                % (len(line), width, line))
+        columns = []
+        for column_type, values in zip(self.schema, zip(*block)):
+            if column_type is not None:
+                columns.append(self._convert_column(column_type, values))
+        return zip(*columns)
+
+    def _convert_column(self, column_type, values):
+        if self.use_numpy and column_type in _NUMPY_TYPES and '' not in values:
+            return numpy.array(values).astype(_NUMPY_TYPES[column_type]).tolist()
+        if column_type == 'bytes':
+            return values
+        convert = _CONVERTERS.get(column_type, column_type)
+        if '' in values:
+            return [None if v == '' else convert(v) for v in values]
+        return map(convert, values)
+
+
+class ReadJSON(ReadFiles):
     '''
-    Reads JSON files. Assumes there is one JSON object per file. Supported
-    keyword arguments for initialization are:
-
-    filename=<filename>. Specifies the json file to read. If no filename is
-        given, then all files in the specified dir will be read.
-
-    dir=<path>. Specifies the directory of the file(s) to be read. Defaults to
-        current working directory.
+    Reads JSON files. By default, assumes there is one JSON object per file.
+    Supports the keyword arguments of ReadFiles, as well as:
 
     convert_unicode=<bool>. If True, returns byte strings rather than unicode
         in the deserialized object. Default is True.
 
     convert_numbers=<bool>. If True, returns byte strings rather than numbers or
         unicode in the deserialized object. Default is False.
+
+    ndjson=<bool>. If True, files hold one JSON value per line (NDJSON), which
+        are read line by line and can be split with split_bytes. If not given,
+        files ending in .ndjson or .jsonl are read as NDJSON.
+
+    stream=<bool>. If True, a file holding a top-level array yields each
+        element as soon as it is parsed, and a file holding a top-level object
+        yields a single-member object for each of its members. Memory use is
+        then bounded by the largest element rather than by the file. Default is
+        False.
     '''
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
         super(ReadJSON, self).__init__(number_producers, number_consumers, **kwargs)
-        self._filename = kwargs.get('filename', '*')
-        self._dir = kwargs.get('dir', os.getcwd())
         self._convert_unicode = kwargs.get('convert_unicode', True)
         self._convert_numbers = kwargs.get('convert_numbers', False)
+        self._ndjson = kwargs.get('ndjson', None)
+        self._stream = kwargs.get('stream', False)
 
-    def _convert(self, input, number=False):
-        if isinstance(input, dict):
-            return {self._convert(key, number): self._convert(value, number)
-                    for key, value in input.iteritems()}
-        elif isinstance(input, list):
-            return [self._convert(element, number) for element in input]
-        elif isinstance(input, unicode):
-            return input.encode('utf-8')
-        elif number and isinstance(input, numbers.Number):
-            return str(input).encode('utf-8')
-        else:
-            return input
+    def is_splittable(self, path):
+        return _is_ndjson(path, self._ndjson)
 
-    def reader(self):
-        for fully_pathed in glob.iglob(os.path.join(self._dir, self._filename)):
-            if not os.path.isfile(fully_pathed): continue
-            with open(fully_pathed, 'r') as json_file:
-                if self._convert_numbers:
-                    json_object = json.load(json_file,
-                                            object_hook=lambda x: self._convert(x, True))
-                elif self._convert_unicode:
-                    json_object = json.load(json_file,
-                                            object_hook=self._convert)
-                else:
-                    json_object = json.load(json_file)
-                yield json_object
+    def parser(self):
+        return _JSONParser(self._convert_unicode, self._convert_numbers,
+                           self._ndjson, self._stream)
+
+
+def _is_ndjson(path, ndjson):
+    if ndjson is not None: return ndjson
+    return os.path.splitext(_uncompressed_name(path))[1].lower() in ('.ndjson', '.jsonl')
+
+
+def _convert(input, number=False):
+    if isinstance(input, dict):
+        return {_convert(key, number): _convert(value, number)
+                for key, value in input.iteritems()}
+    elif isinstance(input, list):
+        return [_convert(element, number) for element in input]
+    elif isinstance(input, unicode):
+        return input.encode('utf-8')
+    elif number and isinstance(input, numbers.Number):
+        return str(input).encode('utf-8')
+    else:
+        return input
+
+
+class _JSONParser(object):
+    run_blocking = None
+
+    def __init__(self, convert_unicode, convert_numbers, ndjson=None, stream=False):
+        self.convert_unicode = convert_unicode
+        self.convert_numbers = convert_numbers
+        self.ndjson = ndjson
+        self.stream = stream
+
+    def _object_hook(self):
+        if self.convert_numbers:
+            return lambda x: _convert(x, True)
+        elif self.convert_unicode:
+            return _convert
+        return None
+
+    # The object hook only sees objects, so convert other top-level values
+    def _finish(self, value):
+        if isinstance(value, dict) or not (self.convert_unicode or self.convert_numbers):
+            return value
+        return _convert(value, self.convert_numbers)
+
+    def __call__(self, path, start, end):
+        decoder = json.JSONDecoder(object_hook=self._object_hook())
+        with _open_input(path, self.run_blocking) as json_file:
+            if _is_ndjson(path, self.ndjson):
+                for line in _range_lines(json_file, start, end):
+                    if line.strip():
+                        yield self._finish(decoder.decode(line))
+            elif self.stream:
+                for key, value in _stream_json(json_file, decoder):
+                    if key is None:
+                        yield self._finish(value)
+                    else:
+                        yield {self._finish(key): self._finish(value)}
+            else:
+                yield decoder.decode(json_file.read())
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARS = frozenset('0123456789+-.eE')
+
+
+# Yields (None, element) for each element of a top-level JSON array, or
+# (key, value) for each member of a top-level JSON object, reading the file
+# incrementally. Any other top-level value is yielded as (None, value).
+def _stream_json(json_file, decoder, block_size=1 << 16):
+    state = {'buffer': '', 'position': 0, 'eof': False}
+
+    def fill():
+        # Discard consumed data, then at least double what is buffered so that
+        # re-parsing an incomplete value stays linear overall.
+        buf = state['buffer'][state['position']:]
+        block = json_file.read(max(block_size, len(buf)))
+        state['eof'] = not block
+        state['buffer'] = buf + block
+        state['position'] = 0
+
+    def next_char():
+        while True:
+            state['position'] = _WHITESPACE.match(state['buffer'], state['position']).end()
+            if state['position'] < len(state['buffer']) or state['eof']:
+                return state['buffer'][state['position']:state['position'] + 1]
+            fill()
+
+    def expect(chars):
+        c = next_char()
+        if not c or c not in chars:
+            raise ValueError('Expected one of %r in JSON stream' % chars)
+        state['position'] += 1
+        return c
+
+    def value():
+        next_char()
+        while True:
+            try:
+                result, end = decoder.raw_decode(state['buffer'], state['position'])
+                # A number or literal at the end of the buffer may continue,
+                # and a number followed by one of its characters, as in "12."
+                # or "1.5e", was cut short by the end of the buffer.
+                buf = state['buffer']
+                if state['eof'] or (end < len(buf) and buf[end] not in _NUMBER_CHARS):
+                    state['position'] = end
+                    return result
+            except ValueError:
+                if state['eof']: raise
+            fill()
+
+    opening = next_char()
+    if opening not in ('[', '{'):
+        yield None, value()
+        return
+    state['position'] += 1
+    closing = ']' if opening == '[' else '}'
+    if next_char() == closing: return
+    while True:
+        if opening == '{':
+            key = value()
+            expect(':')
+            yield key, value()
+        else:
+            yield None, value()
+        if expect(',' + closing) == closing: return
 
 
 class ReadBlob(BulkLoader):
@@ -205,24 +1546,50 @@ class ReadBlob(BulkLoader):
         current working directory.
 
     chunk_size=<int>. Number of bytes to read from file. Default is 10240.
+
+    split_bytes=<int>. Size of the ranges of the file that are read by
+        different producers, rounded down to a multiple of chunk_size. Default
+        is 8 MB.
+
+    decompress=<bool>. If True, a file compressed with gzip, bzip2 or xz is
+        decompressed as it is read, as for ReadFiles, and is read whole by one
+        producer. Otherwise, every file is loaded as stored. Default is False.
     '''
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
         super(ReadBlob, self).__init__(number_producers, number_consumers, **kwargs)
         self._filename = kwargs.get('filename', '*')
         self._dir = kwargs.get('dir', os.getcwd())
         self._chunk_size = kwargs.get('chunk_size', 10240)
+        self._split_bytes = kwargs.get('split_bytes', SPLIT_BYTES)
+        self._decompress = kwargs.get('decompress', False)
 
-    def reader(self):
+    def _work_units(self):
         files_found = list(glob.iglob(os.path.join(self._dir, self._filename)))
         if len(files_found) != 1: raise Exception("Must specify single file")
         fully_pathed = files_found[0]
         if not os.path.isfile(fully_pathed): raise Exception("No file found")
-        with open(fully_pathed, 'rb') as blob_file:
-            file_size = os.stat(fully_pathed).st_size;
-            position = 0
-            while (position < file_size):
+        if self._decompress and _compression(fully_pathed):
+            yield fully_pathed, 0, None
+            return
+        file_size = os.stat(fully_pathed).st_size
+        span = max(self._split_bytes // self._chunk_size, 1) * self._chunk_size
+        for start in xrange(0, file_size, span):
+            yield fully_pathed, start, min(start + span, file_size)
+
+    # Reads chunks from the byte range [start, end) of a file. An end of None
+    # denotes the end of the file.
+    def _read_range(self, path, start, end):
+        if self._decompress:
+            blob_file = _open_input(path, self._backend.run_blocking)
+        else:
+            blob_file = open(path, 'rb')
+        with blob_file:
+            if start: blob_file.seek(start)
+            position = start
+            while end is None or position < end:
                 try:
-                    chunk = blob_file.read(self._chunk_size)
+                    size = self._chunk_size if end is None else min(self._chunk_size, end - position)
+                    chunk = blob_file.read(size)
                     if not chunk: break;
                     offset = position
                     position += self._chunk_size
@@ -230,6 +1597,100 @@ class ReadBlob(BulkLoader):
                 except IOError as e:
                     print "I/O error({0}): {1}".format(e.errno, e.strerror)
 
+    def reader(self):
+        for unit, items in self._unit_readers():
+            for data in items: yield data
+
+    def _unit_readers(self):
+        for unit in self._work_units():
+            yield unit, self._read_range(*unit)
+
+    def unit_key(self, unit):
+        path, start, end = unit
+        return (os.path.abspath(path), start)
+
+
+class ReadSynthetic(BulkLoader):
+    '''
+    Generates synthetic data for benchmarking, deterministically from a seed.
+    Supported keyword arguments for initialization are:
+
+    kind=<string>. 'rows' yields tuples for WriteKVP, 'docs' yields nested
+        documents for WriteDoc, and 'blob' yields (offset, chunk) pairs for
+        WriteBlob. Default is 'rows'.
+
+    rows=<int>. Number of items to generate. Default is 100000.
+
+    width=<int>. Number of fields per row, or children per level of a
+        document. Rows need at least 2 fields, the last of which is written as
+        the value, unless empty_value=True. Default is 4.
+
+    field_bytes=<int>. Size of each generated field or leaf value. Default is
+        16.
+
+    cardinality=<int>. Number of distinct values of each field after the
+        first, which is always unique. Default is 0, meaning all unique.
+
+    depth=<int>. Number of levels below each document. Default is 2.
+
+    chunk_size=<int>. Size of each blob chunk. Default is 10240.
+
+    unit_rows=<int>. Number of items per unit of work shared among producers.
+        Default is 10000.
+
+    seed=<int>. Default is 0.
+    '''
+    def __init__(self, number_producers=1, number_consumers=50, **kwargs):
+        super(ReadSynthetic, self).__init__(number_producers, number_consumers, **kwargs)
+        self._kind = kwargs.get('kind', 'rows')
+        if self._kind not in ('rows', 'docs', 'blob'):
+            raise Exception("kind must be 'rows', 'docs' or 'blob'")
+        self._rows = kwargs.get('rows', 100000)
+        self._width = kwargs.get('width', 4)
+        if self._kind == 'rows' and self._width < (1 if kwargs.get('empty_value') else 2):
+            raise Exception("width must be at least 2 for kind 'rows', or 1 with empty_value=True")
+        self._field_bytes = kwargs.get('field_bytes', 16)
+        self._cardinality = kwargs.get('cardinality', 0)
+        self._depth = kwargs.get('depth', 2)
+        self._chunk_size = kwargs.get('chunk_size', 10240)
+        self._unit_rows = kwargs.get('unit_rows', 10000)
+        self._seed = kwargs.get('seed', 0)
+
+    def _field(self, rng):
+        if self._cardinality:
+            value = rng.randrange(self._cardinality)
+        else:
+            value = rng.getrandbits(63)
+        return ('%x' % value).rjust(self._field_bytes, '0')[:self._field_bytes]
+
+    def _document(self, rng, depth):
+        if not depth: return self._field(rng)
+        return dict(('c%d' % i, self._document(rng, depth - 1)) for i in xrange(self._width))
+
+    def _generate(self, start, end):
+        rng = random.Random(self._seed * 1000003 + start)
+        if self._kind == 'blob':
+            block = ''.join(chr(rng.getrandbits(8)) for _ in xrange(self._chunk_size))
+        for i in xrange(start, end):
+            if self._kind == 'rows':
+                yield ('%016d' % i,) + tuple(self._field(rng) for _ in xrange(self._width - 1))
+            elif self._kind == 'docs':
+                yield {'doc%016d' % i: self._document(rng, self._depth)}
+            else:
+                yield i * self._chunk_size, block
+
+    def reader(self):
+        for unit, items in self._unit_readers():
+            for data in items: yield data
+
+    def _unit_readers(self):
+        for start in xrange(0, self._rows, self._unit_rows):
+            unit = (start, min(start + self._unit_rows, self._rows))
+            yield unit, self._generate(*unit)
+
+    def unit_key(self, unit):
+        return ('synthetic', self._kind, self._seed, unit[0])
+
 
 ####################
 ## Writer classes ##
@@ -249,20 +1710,69 @@ class WriteKVP(BulkLoader):
 
     clear=<bool>. If True, clears the specified subspace before writing to it.
         Default is False.
+
+    upsert=<bool>. If True, the existing values of a batch are read together
+        and only keys whose values differ are written. Unchanged items are
+        counted as skipped in the load statistics. Default is False.
+
+    Values that are not strings, such as numbers from a typed ReadCSV, are
+    stored tuple-encoded. Keys and values are encoded a batch at a time.
     '''
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
         super(WriteKVP, self).__init__(number_producers, number_consumers, **kwargs)
         self._empty_value = kwargs.get('empty_value', False)
         self._subspace = kwargs.get('subspace', Subspace(('bulk_kvp',)))
         self._clear = kwargs.get('clear', False)
-        if self._clear: clear_subspace(db, self._subspace)
+        self._upsert = kwargs.get('upsert', False)
+        if 'float' in (kwargs.get('schema') or ()) and not _packs_floats():
+            raise Exception("Schema column type 'float' requires a tuple layer that can pack floats")
+        if self._clear and not self.resuming(): clear_subspace(self.db, self._subspace)
 
     @fdb.transactional
     def writer(self, tr, data):
+        for key, value in self._encode([data]):
+            tr[key] = value
+
+    def prepare_batch(self, batch):
+        return self._encode(batch)
+
+    def write_prepared(self, tr, prepared):
+        if not self._upsert:
+            for key, value in prepared:
+                tr[key] = value
+            return 0
+        # Issue every read before waiting on any of them
+        old = [tr[key] for key, value in prepared]
+        skipped = 0
+        for (key, value), current in zip(prepared, old):
+            if current.present() and current == value:
+                skipped += 1
+            else:
+                tr[key] = value
+        return skipped
+
+    def _encode(self, items):
+        prefix = self._subspace.key()
+        pack = fdb.tuple.pack
         if self._empty_value:
-            tr[self._subspace.pack(data)] = ''
-        else:
-            tr[self._subspace.pack(data[:-1])] = data[-1]
+            return [(prefix + pack(data), '') for data in items]
+        return [(prefix + pack(data[:-1]),
+                 data[-1] if isinstance(data[-1], str) else pack((data[-1],)))
+                for data in items]
+
+    def destination_key(self, data):
+        return self._subspace.pack(data if self._empty_value else data[:-1])
+
+    def destination_range(self):
+        return self._subspace.range()
+
+
+def _packs_floats():
+    try:
+        fdb.tuple.pack((0.5,))
+        return True
+    except Exception:
+        return False
 
 
 class WriteDoc(BulkLoader):
@@ -277,20 +1787,101 @@ class WriteDoc(BulkLoader):
     document=<Doc()>. Specifies the SimpleDoc object to which data is written.
         Can be used to load a specified collection or arbitrary subdocument.
         Defaults to root.
+
+    defer_indexes=<bool>. If True, indexes that may cover the document are not
+        maintained while produce_and_consume() runs, so writes read no old
+        values. Each is then rebuilt by build_indexes() in a parallel pass over
+        its key range, partitioned as with partition=. The indexes are out of
+        date until the load finishes, and other processes must not write
+        indexed documents meanwhile. If the load fails, maintenance resumes but
+        the indexes stay out of date until build_indexes() is called. Default
+        is False.
+
+    upsert=<bool>. If True, the existing values of a batch's leaves are read
+        together and only changed leaves are written. Documents with no
+        changed leaves are counted as skipped in the load statistics. Default
+        is False.
     '''
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
         super(WriteDoc, self).__init__(number_producers, number_consumers, **kwargs)
         self._document = kwargs.get('document', simpledoc.root)
         self._clear = kwargs.get('clear', False)
-        if self._clear: _simpledoc_clear(db, self._document)
+        self._upsert = kwargs.get('upsert', False)
+        self._deferred = []
+        if kwargs.get('defer_indexes', False):
+            path = self._document._path
+            self._deferred = [i for i in simpledoc.Index.registered if _paths_overlap(i.dkPath, path)]
+        if self._clear and not self.resuming(): _simpledoc_clear(self.db, self._document)
 
+    @fdb.transactional
     def writer(self, tr, data):
-        _writer_doc(db, self._document, data)
+        _writer_doc(tr, self._document, data)
+
+    def write_prepared(self, tr, prepared):
+        if not self._upsert:
+            return super(WriteDoc, self).write_prepared(tr, prepared)
+        return _upsert_docs(tr, self._document, prepared)
+
+    def destination_key(self, data):
+        if not isinstance(data, dict) or not data: return None
+        return self._document[min(data)].get_key()
+
+    def destination_range(self):
+        path = fdb.tuple.unpack(self._document.get_key())
+        return slice(self._document.get_key(), fdb.tuple.range(path).stop)
+
+    # Index maintenance is turned off only while the load runs, so that a
+    # loader that is never run, or whose load fails, leaves it on.
+    def produce_and_consume(self):
+        for index in self._deferred: index.deferred = True
+        try:
+            return super(WriteDoc, self).produce_and_consume()
+        finally:
+            for index in self._deferred: index.deferred = False
+
+    def finish(self):
+        self.build_indexes()
+
+    def build_indexes(self):
+        '''
+        Rebuilds the indexes deferred by defer_indexes=True.
+        '''
+        for index in self._deferred:
+            _simpledoc_clear(self.db, index.index_doc)
+            rng = index.scan_range()
+            keys = [rng.start] + _boundary_keys(self.db, rng.start, rng.stop,
+                                                self._kwargs.get('split_keys', ())) + [rng.stop]
+            pieces = _SharedIterator(zip(keys, keys[1:]), self._backend.lock())
+            workers = [self._backend.spawn(self._backfill, index, pieces)
+                       for _ in xrange(min(self._number_consumers, len(keys) - 1))]
+            self._backend.join(workers)
+            for w in workers:
+                if w.exception is not None: raise w.exception
+
+    def _backfill(self, index, pieces):
+        for begin, end in pieces:
+            while begin is not None:
+                begin = _backfill_page(self.db, index, begin, end, self._batch_rows)
+
+
+def _paths_overlap(a, b):
+    return all(x == '?' or x == y for x, y in zip(a, b))
 
 
 # @simpledoc.transaction is not signature-preserving and so is used with
 # functions rather than methods.
 
+# simpledoc keeps its transaction in a threading.local, which the greenlets of
+# the gevent backend share, so another greenlet may replace it whenever one
+# waits. It is therefore set only around writes that do not wait.
+@contextlib.contextmanager
+def _simpledoc_transaction(tr):
+    simpledoc.thread_local.tr = tr
+    try:
+        yield
+    finally:
+        simpledoc.thread_local.tr = None
+
 @simpledoc.transactional
 def _simpledoc_clear(document):
     document.clear_all()
@@ -305,12 +1896,57 @@ def no_arrays(input):
         return True
 
 
+# Adds index entries for a page of existing values and returns the key from
+# which to continue, or None at the end of the range. Values are read at
+# snapshot isolation, so backfills conflict only on the index entries. The
+# whole page is read before the entries, which need no reads, are written.
+@fdb.transactional
+def _backfill_page(tr, index, begin, end, limit):
+    page = list(tr.snapshot.get_range(begin, end, limit=limit))
+    with _simpledoc_transaction(tr):
+        for k, v in page:
+            path = fdb.tuple.unpack(k)
+            if index.matches(path):
+                index.backfill(simpledoc.root.get_descendant(path[1:]), v)
+    if len(page) < limit: return None
+    return fdb.KeySelector.first_greater_than(page[-1].key)
+
+
 @simpledoc.transactional
 def _writer_doc(document, data):
     assert no_arrays(data), 'JSON object contains arrays'
     document.update(data)
 
 
+# Returns (node, value) for each value in data, which is to be written at document.
+def _doc_leaves(document, data):
+    if not isinstance(data, dict):
+        return [(document, data)]
+    return [leaf for k, v in data.iteritems() for leaf in _doc_leaves(document[k], v)]
+
+
+# Writes the changed leaves of each item and returns the number of unchanged
+# items. Existing values are read as stored by CorePlugin. Every comparison,
+# which waits for the reads, is made before any leaf is written.
+def _upsert_docs(tr, document, items):
+    leaves = []
+    for data in items:
+        assert no_arrays(data), 'JSON object contains arrays'
+        leaves.append(_doc_leaves(document, data))
+    old = [[tr[node.get_key()] for node, value in item] for item in leaves]
+    skipped = 0
+    changed = []
+    for item, current in zip(leaves, old):
+        item_changed = [(node, value) for (node, value), c in zip(item, current)
+                        if not (c.present() and c == value)]
+        if not item_changed: skipped += 1
+        changed.extend(item_changed)
+    with _simpledoc_transaction(tr):
+        for node, value in changed:
+            node.update(value)
+    return skipped
+
+
 class WriteBlob(BulkLoader):
     '''
     Writes data as a blob using the Blob layer. Supported keyword arguments for
@@ -321,18 +1957,47 @@ class WriteBlob(BulkLoader):
 
     blob=<Doc()>. Specifies the Blob object to which data is written. Default is
         Blob(Subspace('bulk_blob',)).
+
+    ingest=<bool>. If True, chunks are written at their offsets with
+        Blob.ingest(), which performs no reads, and the size of the blob is set
+        once at the end of the load. Concurrent writers then never conflict.
+        The blob must hold no data where chunks are written, as when loading a
+        new blob or with clear=True. Default is False.
     '''
     def __init__(self, number_producers=1, number_consumers=50, **kwargs):
         super(WriteBlob, self).__init__(number_producers, number_consumers, **kwargs)
         self._blob = kwargs.get('blob', blob.Blob(Subspace(('bulk_blob',))))
         self._clear = kwargs.get('clear', False)
-        if self._clear: self._blob.delete(db)
+        self._ingest = kwargs.get('ingest', False)
+        if self._clear and not self.resuming(): self._blob.delete(self.db)
 
     @fdb.transactional
     def writer(self, tr, data):
         offset = data[0]
         chunk = data[1]
-        self._blob.write(tr, offset, chunk)
+        if self._ingest:
+            self._blob.ingest(tr, offset, chunk)
+        else:
+            self._blob.write(tr, offset, chunk)
+
+    def finish(self):
+        if self._ingest: _finish_ingest(self.db, self._blob)
+
+    def destination_key(self, data):
+        return self._blob._data_key(data[0])
+
+    def destination_range(self):
+        return self._blob.subspace.range()
+
+
+# Sets the size of an ingested blob to the end of its last chunk, which may
+# have been written by an earlier, interrupted load.
+@fdb.transactional
+def _finish_ingest(tr, b):
+    data = b.subspace.range((blob.DATA_KEY,))
+    for k, v in tr.get_range(data.start, data.stop, limit=1, reverse=True):
+        end = int(b.subspace.unpack(k)[-1]) + len(v)
+        if end > b.get_size(tr): b.set_size(tr, end)
 
 
 ##################################
@@ -354,6 +2019,341 @@ class BlobToBlob(ReadBlob, WriteBlob):
         super(BlobToBlob, self).__init__(number_producers, number_consumers, **kwargs)
 
 
+class SyntheticToKVP(ReadSynthetic, WriteKVP):
+    def __init__(self, number_producers=1, number_consumers=50, **kwargs):
+        super(SyntheticToKVP, self).__init__(number_producers, number_consumers, **kwargs)
+
+
+class SyntheticToDoc(ReadSynthetic, WriteDoc):
+    def __init__(self, number_producers=1, number_consumers=50, **kwargs):
+        super(SyntheticToDoc, self).__init__(number_producers, number_consumers, **kwargs)
+
+
+class SyntheticToBlob(ReadSynthetic, WriteBlob):
+    def __init__(self, number_producers=1, number_consumers=50, **kwargs):
+        super(SyntheticToBlob, self).__init__(number_producers, number_consumers, **kwargs)
+
+
+###############
+## Benchmark ##
+###############
+
+def benchmark(kind='rows', number_producers=1, number_consumers=50, **kwargs):
+    '''
+    Loads synthetic data of the given kind with the matching writer and returns
+    the run's LoadStats report, extended with the CPU time used. Keyword
+    arguments are passed to the loader; by default each kind is written to its
+    own benchmark location, which is cleared first.
+    '''
+    loaders = {'rows': SyntheticToKVP, 'docs': SyntheticToDoc, 'blob': SyntheticToBlob}
+    kwargs.setdefault('clear', True)
+    kwargs.setdefault('subspace', Subspace(('bulk_benchmark',)))
+    kwargs.setdefault('document', simpledoc.root.bulk_benchmark)
+    kwargs.setdefault('blob', blob.Blob(Subspace(('bulk_benchmark_blob',))))
+    loader = loaders[kind](number_producers, number_consumers, kind=kind, **kwargs)
+
+    cpu_start = os.times()
+    stats = loader.produce_and_consume()
+    cpu_end = os.times()
+
+    report = stats.report()
+    report['kind'] = kind
+    report['number_producers'] = number_producers
+    report['number_consumers'] = number_consumers
+    report['cpu_user'] = cpu_end[0] - cpu_start[0]
+    report['cpu_system'] = cpu_end[1] - cpu_start[1]
+    report['cpu_utilization'] = (report['cpu_user'] + report['cpu_system']) / report['elapsed']
+    return report
+
+
+####################
+## Export classes ##
+####################
+
+class BulkExporter(_BulkBase):
+    '''
+    Exports a range of keys to a file. The range is divided at the cluster's
+    shard boundaries, and the pieces are read concurrently by up to
+    number_readers transactions. Pages of key-value pairs are streamed to the
+    file in key order. Supported keyword arguments are:
+
+    filename=<filename>. Specifies the file to write. Required.
+
+    split_keys=<list>. Additional keys at which to divide the range. Default
+        is [].
+
+    page_rows=<int>. Number of key-value pairs read per request. Default is
+        1000.
+
+    queue_pages=<int>. Number of pages each reader may read ahead of the file
+        writer. Default is 10.
+
+    consistent=<bool>. If True, every piece is read at the read version taken
+        when the export starts, so the output is a consistent snapshot. As with
+        any transaction, the read version expires after about five seconds, so
+        an export that takes longer fails with transaction_too_old. If False,
+        each reader moves to a fresh read version whenever its version
+        expires. Every page is then read at a single version and every key is
+        exported once, but changes made during the export may appear in some
+        pages and not in others. Default is None, which starts as for True
+        and continues as for False once the snapshot has expired.
+
+    backend=<string or object>, db=<Database>. As for BulkLoader.
+    '''
+    def __init__(self, number_readers=50, **kwargs):
+        super(BulkExporter, self).__init__(**kwargs)
+        self._number_readers = number_readers
+        self._filename = kwargs['filename']
+        self._split_keys = kwargs.get('split_keys', ())
+        self._page_rows = kwargs.get('page_rows', 1000)
+        self._queue_pages = kwargs.get('queue_pages', 10)
+        self._consistent = kwargs.get('consistent', None)
+        self._read_version = None  # Shared by readers until the snapshot expires
+        self._kwargs = kwargs
+
+    def _pieces(self):
+        source = self.source_range()
+        keys = self.align_boundaries(_boundary_keys(self.db, source.start, source.stop, self._split_keys))
+        keys = [source.start] + [k for k in keys if source.start < k < source.stop] + [source.stop]
+        return zip(keys[:-1], keys[1:])
+
+    # Puts a page on a reader's queue, giving up if the export has stopped.
+    def _put_page(self, queue, page):
+        while not self._stopping:
+            try:
+                queue.put(page, timeout=1.0)
+                return
+            except Full:
+                pass
+
+    def _read_piece(self, begin, end, queue):
+        tr = self.db.create_transaction()
+        version = self._read_version
+        if version is not None: tr.set_read_version(version)
+        try:
+            while True:
+                try:
+                    page = list(tr.snapshot.get_range(begin, end, limit=self._page_rows))
+                except fdb.FDBError as e:
+                    if e.code == 1007 and version is not None:
+                        # The snapshot can no longer be read
+                        if self._consistent: raise
+                        self._read_version = None
+                    # Resetting the transaction gives it a fresh read version
+                    tr.on_error(e.code).wait()
+                    version = self._read_version
+                    if version is not None: tr.set_read_version(version)
+                    continue
+                if page: self._put_page(queue, page)
+                if len(page) < self._page_rows: break
+                begin = fdb.KeySelector.first_greater_than(page[-1].key)
+            self._put_page(queue, _END)
+        except Exception as e:
+            self._put_page(queue, e)
+
+    # Readers take pieces in key order, so the pieces being read are always
+    # those the file writer needs next.
+    def _reader(self, pieces):
+        for (begin, end), queue in pieces:
+            if self._stopping: return
+            self._read_piece(begin, end, queue)
+
+    def export(self):
+        backend = self._backend
+        self._stopping = False
+        version = self.db.create_transaction().get_read_version().wait()
+        if self._consistent is not False: self._read_version = version
+        pieces = self._pieces()
+        queues = [backend.queue(self._queue_pages) for _ in pieces]
+        shared = _SharedIterator(zip(pieces, queues), backend.lock())
+        readers = [backend.spawn(self._reader, shared)
+                   for _ in xrange(min(self._number_readers, len(pieces)))]
+
+        try:
+            with open(self._filename, 'wb') as f:
+                self.begin_output(f, version)
+                for queue in queues:
+                    while True:
+                        page = queue.get()
+                        if page is _END: break
+                        if isinstance(page, Exception): raise page
+                        self.write_page(f, page)
+                self.end_output(f)
+        finally:
+            self._stopping = True
+            backend.kill(readers)
+
+    # Interface stub to be overridden by a subclass. Method should return a
+    # slice of the keys to be exported. By default, every key outside the
+    # system keyspace.
+    def source_range(self):
+        return slice('', '\xff')
+
+    # May be overridden by a subclass that needs pieces to begin at particular
+    # keys, such as the first key of a document.
+    def align_boundaries(self, keys):
+        return keys
+
+    # Interface stubs to be overridden by a subclass. write_page is called for
+    # each page of key-value pairs in key order, and by default writes each
+    # pair as a line of the key and value in repr form.
+    def begin_output(self, f, version):
+        pass
+
+    def write_page(self, f, page):
+        for k, v in page:
+            f.write('%r\t%r\n' % (k, v))
+
+    def end_output(self, f):
+        pass
+
+
+class KVPtoCSV(BulkExporter):
+    '''
+    Exports the key-value pairs of a subspace as CSV rows, the inverse of
+    CSVtoKVP. Supports the keyword arguments of BulkExporter, as well as:
+
+    subspace=<Subspace()>. Specifies the subspace to export. Default is
+        Subspace(('bulk_kvp',)).
+
+    empty_value=<bool>. If True, each row holds only the elements of the key.
+        Otherwise, the value is appended as the last field. Default is False.
+
+    delimiter=<string>. Defaults to ','.
+
+    unpack_values=<bool>. If True, values are decoded with the tuple layer, as
+        WriteKVP stores values that are not byte strings, such as the numbers
+        and unicode of a ReadCSV schema. Set it when the last column of the
+        loaded schema was not 'bytes'. Default is False, which writes values as
+        stored.
+
+    Unicode fields are written encoded as UTF-8, and None as an empty field.
+    '''
+    def __init__(self, number_readers=50, **kwargs):
+        super(KVPtoCSV, self).__init__(number_readers, **kwargs)
+        self._subspace = kwargs.get('subspace', Subspace(('bulk_kvp',)))
+        self._empty_value = kwargs.get('empty_value', False)
+        self._delimiter = kwargs.get('delimiter', ',')
+        self._unpack_values = kwargs.get('unpack_values', False)
+
+    def source_range(self):
+        return self._subspace.range()
+
+    def begin_output(self, f, version):
+        self._csv_writer = csv.writer(f, delimiter=self._delimiter)
+
+    def write_page(self, f, page):
+        for k, v in page:
+            row = self._subspace.unpack(k)
+            if not self._empty_value:
+                row += fdb.tuple.unpack(v) if self._unpack_values else (v,)
+            self._csv_writer.writerow([field.encode('utf-8') if isinstance(field, unicode) else field
+                                       for field in row])
+
+
+class DocToJSON(BulkExporter):
+    '''
+    Exports a SimpleDoc document as NDJSON, with one line of the form
+    {name: value} for each child of the document, the inverse of JSONtoDoc
+    with ndjson=True. A node with both a value and children is written with its
+    value under "__value__". Names and values are decoded as latin-1, as by
+    simpledoc's own JSON output, so binary data such as the names of a list
+    built with prepend() can be exported. Supports the keyword arguments of
+    BulkExporter, as well as:
+
+    document=<Doc()>. Specifies the SimpleDoc object to export. Defaults to
+        root.
+    '''
+    def __init__(self, number_readers=50, **kwargs):
+        super(DocToJSON, self).__init__(number_readers, **kwargs)
+        self._document = kwargs.get('document', simpledoc.root)
+        self._path = fdb.tuple.unpack(self._document.get_key())
+
+    def source_range(self):
+        # Values of the children and their descendants, but not of the document
+        return fdb.tuple.range(self._path)
+
+    # Begin every piece at the key of a child so that no child is split
+    def align_boundaries(self, keys):
+        aligned = set()
+        depth = len(self._path)
+        for k in keys:
+            try:
+                path = fdb.tuple.unpack(k)
+            except Exception:
+                continue
+            if len(path) > depth and path[:depth] == self._path:
+                aligned.add(fdb.tuple.pack(path[:depth + 1]))
+        return sorted(aligned)
+
+    def begin_output(self, f, version):
+        self._child = None
+        self._value = None
+
+    def _flush(self, f):
+        if self._child is not None:
+            # Names and values are bytes, written as simpledoc serializes them
+            f.write(json.dumps({self._child: self._value}, encoding='latin-1'))
+            f.write('\n')
+
+    def write_page(self, f, page):
+        depth = len(self._path)
+        for k, v in page:
+            path = fdb.tuple.unpack(k)[depth:]
+            if path[0] != self._child:
+                self._flush(f)
+                self._child = path[0]
+                self._value = None
+            if len(path) == 1:
+                self._value = v
+                continue
+            if not isinstance(self._value, dict):
+                self._value = {} if self._value is None else {'__value__': self._value}
+            node = self._value
+            for name in path[1:-1]:
+                child = node.get(name)
+                if not isinstance(child, dict):
+                    child = node[name] = {} if child is None else {'__value__': child}
+                node = child
+            if isinstance(node.get(path[-1]), dict):
+                node[path[-1]]['__value__'] = v
+            else:
+                node[path[-1]] = v
+
+    def end_output(self, f):
+        self._flush(f)
+
+
+class BlobToFile(BulkExporter):
+    '''
+    Exports a blob to a file, the inverse of BlobToBlob. Chunks are written at
+    their offsets, and sparse regions of the blob are left as holes. Supports
+    the keyword arguments of BulkExporter, as well as:
+
+    blob=<Blob()>. Specifies the Blob object to export. Default is
+        Blob(Subspace(('bulk_blob',))).
+    '''
+    def __init__(self, number_readers=50, **kwargs):
+        super(BlobToFile, self).__init__(number_readers, **kwargs)
+        self._blob = kwargs.get('blob', blob.Blob(Subspace(('bulk_blob',))))
+
+    def source_range(self):
+        return self._blob.subspace.range((blob.DATA_KEY,))
+
+    def begin_output(self, f, version):
+        tr = self.db.create_transaction()
+        tr.set_read_version(version)
+        self._size = self._blob.get_size(tr)
+
+    def write_page(self, f, page):
+        for k, v in page:
+            f.seek(int(self._blob.subspace.unpack(k)[-1]))
+            f.write(v)
+
+    def end_output(self, f):
+        f.truncate(self._size)
+
+
 '''
 The following functions illustrate the format for using the combined subclasses:
 
@@ -373,4 +2373,47 @@ def test_blob_blob():
     tasks = BlobToBlob(1, 5, dir='BlobDir', filename='hamlet.txt', blob=my_blob)
     tasks.produce_and_consume()
 
+
+def test_kvp_csv():
+    KVPtoCSV(10, filename='bar.csv', subspace=Subspace(('bar',))).export()
+
+
+def test_doc_json():
+    DocToJSON(10, filename='animals.ndjson', document=simpledoc.root.animals).export()
+
 '''
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark BulkLoader with synthetic data.')
+    parser.add_argument('--kind', choices=['rows', 'docs', 'blob'], default='rows')
+    parser.add_argument('--producers', type=int, default=1)
+    parser.add_argument('--consumers', type=int, default=50)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--width', type=int, default=4)
+    parser.add_argument('--field-bytes', type=int, default=16)
+    parser.add_argument('--cardinality', type=int, default=0)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--chunk-size', type=int, default=10240)
+    parser.add_argument('--batch-bytes', type=int, default=10240)
+    parser.add_argument('--batch-rows', type=int, default=1000)
+    parser.add_argument('--adaptive', action='store_true')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='gevent')
+    parser.add_argument('--progress-interval', type=float, default=0,
+                        help='print progress to stderr every so many seconds')
+    args = parser.parse_args()
+
+    print json.dumps(benchmark(args.kind, args.producers, args.consumers,
+                               rows=args.rows, width=args.width,
+                               field_bytes=args.field_bytes,
+                               cardinality=args.cardinality, depth=args.depth,
+                               chunk_size=args.chunk_size,
+                               batch_bytes=args.batch_bytes,
+                               batch_rows=args.batch_rows,
+                               adaptive=args.adaptive,
+                               backend=args.backend,
+                               progress=args.progress_interval > 0,
+                               progress_interval=args.progress_interval),
+                     indent=2, sort_keys=True)
@@ -10,21 +10,37 @@ directly by the database.
 
 Provides the Counter class, which represents an integer value in the
 database which can be incremented, added to, or subtracted from within
-a transaction without conflict.
+a transaction without conflict. The technique is generalized by the
+ShardedAggregate class, which takes a reducer such as IntSum, FloatSum,
+Min, Max, BitwiseOr, SetUnion or HyperLogLog.
+
+Counter can also keep its value with atomic operations instead of shards,
+either on one key (backend='atomic') or spread over several keys
+(backend='hybrid'), behind the same interface. Run "python counter.py
+benchmark [threads] [increments]" to compare the backends.
 
 """
 
 import fdb
 import fdb.tuple
+import hashlib
+import math
 import random
 import os
+import pickle
+import struct
+import sys
+import threading
+import time
+import traceback
 from directory import directory
+from subspace import Subspace
 
 fdb.api_version(100)
 
-###########
-# Counter #
-###########
+############
+# Reducers #
+############
 
 def _encode_int(i):
     return fdb.tuple.pack((i,)) # use the tuple layer to pack integers
@@ -32,40 +48,209 @@ def _encode_int(i):
 def _decode_int(s):
     return fdb.tuple.unpack(s)[0]
 
+class IntSum:
+    """Sum of integers, the reducer used by Counter.
+
+    A reducer defines the associative, commutative operation of a
+    ShardedAggregate. Values passed to add() are turned into states by
+    lift(), states are merged by combine() and stored with encode() and
+    decode(), and get() returns result() of the merged state. identity is
+    the state of an aggregate with no shards.
+    """
+    identity = 0
+
+    def lift(self, x):
+        return x
+
+    def combine(self, a, b):
+        return a + b
+
+    def encode(self, state):
+        return _encode_int(state)
+
+    def decode(self, s):
+        return _decode_int(s)
+
+    def result(self, state):
+        return state
+
+class FloatSum (IntSum):
+    """Sum of floating-point numbers."""
+    identity = 0.0
+
+    def lift(self, x):
+        return float(x)
+
+    def encode(self, state):
+        return struct.pack('>d', state)
+
+    def decode(self, s):
+        return struct.unpack('>d', s)[0]
+
+class Min (IntSum):
+    """Smallest of the values added, which may be any tuple-encodable values,
+    or None if none were."""
+    identity = None
+
+    def combine(self, a, b):
+        if a is None: return b
+        if b is None: return a
+        return min(a, b)
+
+    def encode(self, state):
+        return fdb.tuple.pack((state,))
+
+class Max (Min):
+    """Largest of the values added, or None if none were."""
+
+    def combine(self, a, b):
+        if a is None: return b
+        if b is None: return a
+        return max(a, b)
+
+class BitwiseOr (IntSum):
+    """Bitwise or of non-negative integers, such as bit sets of flags."""
+
+    def combine(self, a, b):
+        return a | b
+
+class SetUnion (IntSum):
+    """Union of the tuple-encodable elements added."""
+    identity = frozenset()
+
+    def lift(self, x):
+        return frozenset([x])
+
+    def combine(self, a, b):
+        return a | b
+
+    def encode(self, state):
+        return fdb.tuple.pack(tuple(sorted(state)))
+
+    def decode(self, s):
+        return frozenset(fdb.tuple.unpack(s))
+
+class HyperLogLog (IntSum):
+    """Approximate number of distinct values added.
+
+    Each state is a HyperLogLog sketch of 2**precision one-byte registers,
+    with a standard error of about 1.04 / sqrt(2**precision).
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.size = 1 << precision
+        self.identity = '\x00' * self.size
+
+    def lift(self, x):
+        h = struct.unpack('>Q', hashlib.sha1(str(x)).digest()[:8])[0]
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        state = bytearray(self.size)
+        state[index] = rank
+        return state
+
+    def combine(self, a, b):
+        return bytearray(map(max, bytearray(a), bytearray(b)))
+
+    def encode(self, state):
+        return str(state)
+
+    def decode(self, s):
+        return bytearray(s)
+
+    def result(self, state):
+        state = bytearray(state)
+        m = float(self.size)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in state)
+        zeros = sum(1 for r in state if r == 0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros) # small range correction
+        return int(round(estimate))
+
+####################
+# ShardedAggregate #
+####################
+
 def randID():
     return os.urandom(20) # this relies on good random data from the OS to avoid collisions
 
-class Counter:
-    """Represents an integer value which can be incremented without conflict.
+def _count_shards(db, subspace, limit):
+    tr = db.create_transaction()
+    while True:
+        try:
+            return len(list(tr.snapshot.get_range(subspace.range().start,
+                                                  subspace.range().stop,
+                                                  limit=limit or 0)))
+        except fdb.FDBError as e:
+            tr.on_error(e.code).wait()
+
+def _combine_shards(reducer, shards):
+    state = reducer.identity
+    for k,v in shards:
+        state = reducer.combine(state, reducer.decode(v))
+    return state
+
+def _reduce(reducer, shards):
+    return reducer.result(_combine_shards(reducer, shards))
+
+class ShardedAggregate:
+    """Represents an aggregate of values under any associative, commutative
+    reducer, to which values can be added without conflict.
 
     Uses a sharded representation (which scales with contention) along
-    with background coalescing.
+    with background coalescing. By default, add() sometimes coalesces
+    shards itself. While a Coalescer started by start_coalescer() is
+    running, add() is a single blind write and the Coalescer keeps the
+    number of shards near its target.
+
+    get_cached() serves reads from a local copy of the value. If
+    change_marker is True, add() also writes a marker key, which lets
+    get_cached() keep serving an unchanged value without reading again.
 
     """
 
-    def __init__(self, db, subspace):
+    def __init__(self, db, subspace, reducer, change_marker=False):
         self.subspace = subspace
         self.db = db
+        self.reducer = reducer
+        self.coalescer = None
+        self.change_marker = change_marker
+        self._cache_lock = threading.Lock()
+        self._cached = None  # (value, time read, watch generation)
+        self._generation = 0  # incremented when the marker changes
 
-    def _coalesce(self, N):
-        total = 0
-        tr = self.db.create_transaction()
-        try:
+    def _merge_shards(self, tr, N):
+        """Replace up to N shards with a single one. Returns the number merged."""
+        reducer = self.reducer
+        state = reducer.identity
+        count = 0
 
-            # read N writes from a random place in ID space
-            loc = self.subspace.pack((randID(),))
-            if random.random() < 0.5:
-                shards = tr.snapshot.get_range(loc, self.subspace.range().stop, limit=N);
-            else:
-                shards = tr.snapshot.get_range(self.subspace.range().start, loc, limit=N, reverse = True);
+        # read N writes from a random place in ID space
+        loc = self.subspace.pack((randID(),))
+        if random.random() < 0.5:
+            shards = tr.snapshot.get_range(loc, self.subspace.range().stop, limit=N);
+        else:
+            shards = tr.snapshot.get_range(self.subspace.range().start, loc, limit=N, reverse = True);
 
-            # remove read shards transaction
-            for k,v in shards:
-                total += _decode_int(v)
-                tr[k] # real read for isolation
-                del tr[k]
+        # remove read shards transaction
+        for k,v in shards:
+            state = reducer.combine(state, reducer.decode(v))
+            tr[k] # real read for isolation
+            del tr[k]
+            count += 1
 
-            tr[self.subspace.pack((randID(),))] = _encode_int(total)
+        if count < 2:
+            tr.reset() # nothing to merge
+            return 0
+        tr[self.subspace.pack((randID(),))] = reducer.encode(state)
+        return count
+
+    def _coalesce(self, N):
+        tr = self.db.create_transaction()
+        try:
+            self._merge_shards(tr, N)
 
             ## note: no .wait() on the commit below--this just goes off
             ## into the ether and hopefully sometimes works :)
@@ -79,38 +264,147 @@ class Counter:
         except fdb.FDBError as e:
             pass
 
+    def count_shards(self, limit=None):
+        """Return the number of shards, counting no more than limit."""
+        return _count_shards(self.db, self.subspace, limit)
+
+    def start_coalescer(self, **kwargs):
+        """Start a Coalescer for this aggregate with the given arguments."""
+        self.stop_coalescer()
+        self.coalescer = Coalescer(self, **kwargs)
+        self.coalescer.start()
+        return self.coalescer
+
+    def stop_coalescer(self):
+        """Stop the aggregate's Coalescer, if one is running."""
+        if self.coalescer is not None:
+            self.coalescer.stop()
+            self.coalescer = None
+
     @fdb.transactional
     def get_transactional(self, tr):
-        """Get the value of the counter.
+        """Get the value of the aggregate.
 
-        Not recommended for use with read/write transactions when the counter
+        Not recommended for use with read/write transactions when the aggregate
         is being frequently updated (conflicts will be very likely).
         """
-        total = 0
-        for k,v in tr[self.subspace.range()]:
-            total += _decode_int(v)
-        return total
+        return _reduce(self.reducer, tr[self.subspace.range()])
 
     @fdb.transactional
     def get_snapshot(self, tr):
         """
-        Get the value of the counter with snapshot isolation (no
+        Get the value of the aggregate with snapshot isolation (no
         transaction conflicts).
         """
-        total = 0
-        for k,v in tr.snapshot[self.subspace.range()]:
-            total += _decode_int(v)
-        return total
+        return _reduce(self.reducer, tr.snapshot[self.subspace.range()])
+
+    def get_cached(self, max_staleness=1.0):
+        """
+        Get the value of the aggregate from a local cache, reading it from the
+        database only if the cached value is more than max_staleness seconds
+        old. With a change marker, a cached value is also served for as long
+        as the aggregate has not changed since it was read. Only one thread
+        reads at a time; the others wait for its result.
+        """
+        with self._cache_lock:
+            if self._cached is not None:
+                value, read_time, generation = self._cached
+                if self.change_marker and generation == self._generation:
+                    return value
+                if time.time() - read_time <= max_staleness:
+                    return value
+
+            read_time = time.time()
+            generation = self._generation
+            tr = self.db.create_transaction()
+            while True:
+                try:
+                    value = self.get_snapshot(tr)
+                    if self.change_marker:
+                        watch = tr.watch(self.subspace.key())
+                    tr.commit().wait()
+                    break
+                except fdb.FDBError as e:
+                    tr.on_error(e.code).wait()
+            if self.change_marker:
+                watch.on_ready(lambda _, generation=generation: self._changed(generation))
+            self._cached = (value, read_time, generation)
+            return value
+
+    def _changed(self, generation):
+        # Called by the watch from the network thread. A watch that fails is
+        # treated as a change, so the next read refreshes and watches again.
+        if generation == self._generation:
+            self._generation += 1
+
+    def _write_state(self, tr, state):
+        tr[self.subspace.pack((randID(),))] = self.reducer.encode(state)
+        if self.change_marker:
+            tr[self.subspace.key()] = randID() # wakes watches in get_cached()
+
+        # Sometimes, coalesce the shards
+        if self.coalescer is None and random.random() < 0.1:
+            self._coalesce(20)
 
     @fdb.transactional
     def add(self, tr, x):
-        """Add the value x to the counter."""
+        """Add the value x to the aggregate."""
+        self._write_state(tr, self.reducer.lift(x))
 
-        tr[self.subspace.pack((randID(),))] = _encode_int(x)
+###########
+# Counter #
+###########
 
-        # Sometimes, coalesce the counter shards
-        if random.random() < 0.1:
-            self._coalesce(20)
+class _AtomicIntSum (IntSum):
+    """Sum of integers stored as the little-endian 64-bit values used by
+    the atomic add operation."""
+
+    def encode(self, state):
+        return struct.pack('<q', state)
+
+    def decode(self, s):
+        return struct.unpack('<q', s)[0]
+
+class Counter (ShardedAggregate):
+    """Represents an integer value which can be incremented without conflict.
+
+    The backend selects the representation:
+
+        'sharded' - a ShardedAggregate whose reducer is IntSum (the default).
+        'atomic'  - a single key updated with the atomic add operation.
+        'hybrid'  - atomic_keys keys, each add() updating one at random with
+                    the atomic add operation, which spreads a hot counter
+                    over several storage servers.
+
+    The atomic backends store 64-bit values, never need coalescing, and
+    cannot read a counter written by the sharded backend or vice versa.
+
+    """
+
+    def __init__(self, db, subspace, change_marker=False, backend='sharded', atomic_keys=16):
+        if backend == 'sharded':
+            reducer = IntSum()
+        elif backend in ('atomic', 'hybrid'):
+            reducer = _AtomicIntSum()
+        else:
+            raise ValueError("backend must be 'sharded', 'atomic' or 'hybrid'")
+        ShardedAggregate.__init__(self, db, subspace, reducer, change_marker)
+        self.backend = backend
+        self.atomic_keys = atomic_keys if backend == 'hybrid' else 1
+
+    def _write_state(self, tr, state):
+        if self.backend == 'sharded':
+            ShardedAggregate._write_state(self, tr, state)
+            return
+        key = self.subspace.pack((random.randrange(self.atomic_keys),))
+        tr.add(key, self.reducer.encode(state))
+        if self.change_marker:
+            tr[self.subspace.key()] = randID() # wakes watches in get_cached()
+
+    def start_coalescer(self, **kwargs):
+        if self.backend != 'sharded':
+            raise ValueError('only the sharded backend uses a coalescer')
+        return ShardedAggregate.start_coalescer(self, **kwargs)
 
     ## sets the counter to the value x
     @fdb.transactional
@@ -119,6 +413,562 @@ class Counter:
         value = self.get_snapshot(tr)
         self.add(tr, x - value)
 
+##############
+# CounterSet #
+##############
+
+# The shards of a counter are stored at its name followed by None and the
+# shard ID. Names never contain None, so the shards of one name form a range
+# holding no shard of a longer name.
+
+def _name_tuple(name):
+    return name if isinstance(name, tuple) else (name,)
+
+def _shard_prefix(name):
+    return _name_tuple(name) + (None,)
+
+def _name_from_tuple(t):
+    t = t[:-1] # drop the None before the shard ID
+    return t[0] if len(t) == 1 else t
+
+class CounterSet:
+    """Represents many named counters stored in a single subspace.
+
+    A name is a string or a tuple of strings or integers, which may not
+    contain None. Each counter is sharded as in
+    Counter, with its shards stored together under its name, so that
+    counters whose names share a tuple prefix are adjacent and can be
+    totalled with a single range read. Shards are merged by a Coalescer
+    started with start_coalescer(), or otherwise occasionally by add().
+
+    The counters are integer sums unless another reducer is given, as for
+    ShardedAggregate, in which case "total" means the reduction over names.
+
+    """
+
+    def __init__(self, db, subspace, reducer=None):
+        self.subspace = subspace
+        self.db = db
+        self.reducer = reducer or IntSum()
+        self.coalescer = None
+
+    def _merge_shards(self, tr, N):
+        """
+        Read up to N shards from a random place and replace the shards of
+        each name found more than once with a single one. Returns the number
+        merged.
+        """
+        loc = self.subspace.pack((randID(),))
+        if random.random() < 0.5:
+            shards = tr.snapshot.get_range(loc, self.subspace.range().stop, limit=N)
+        else:
+            shards = tr.snapshot.get_range(self.subspace.range().start, loc, limit=N, reverse=True)
+
+        by_prefix = {}
+        for k, v in shards:
+            by_prefix.setdefault(self.subspace.unpack(k)[:-1], []).append((k, v))
+
+        reducer = self.reducer
+        count = 0
+        for prefix, name_shards in by_prefix.iteritems():
+            if len(name_shards) < 2:
+                continue
+            state = reducer.identity
+            for k, v in name_shards:
+                state = reducer.combine(state, reducer.decode(v))
+                tr[k] # real read for isolation
+                del tr[k]
+            tr[self.subspace.pack(prefix + (randID(),))] = reducer.encode(state)
+            count += len(name_shards)
+        return count
+
+    def _coalesce(self, N):
+        tr = self.db.create_transaction()
+        try:
+            if self._merge_shards(tr, N):
+                c = tr.commit()
+                def hold(_,tr=tr): pass
+                c.on_ready(hold)
+        except fdb.FDBError:
+            pass
+
+    def count_shards(self, limit=None):
+        """Return the number of shards of all counters, counting no more than limit."""
+        return _count_shards(self.db, self.subspace, limit)
+
+    def start_coalescer(self, **kwargs):
+        """Start a Coalescer for this set with the given arguments."""
+        self.stop_coalescer()
+        self.coalescer = Coalescer(self, **kwargs)
+        self.coalescer.start()
+        return self.coalescer
+
+    def stop_coalescer(self):
+        """Stop the set's Coalescer, if one is running."""
+        if self.coalescer is not None:
+            self.coalescer.stop()
+            self.coalescer = None
+
+    def _write_states(self, tr, states):
+        for name, state in states.iteritems():
+            tr[self.subspace.pack(_shard_prefix(name) + (randID(),))] = self.reducer.encode(state)
+
+        # Sometimes, coalesce the counter shards
+        if self.coalescer is None and random.random() < 0.1:
+            self._coalesce(20 + len(states))
+
+    @fdb.transactional
+    def add(self, tr, deltas):
+        """Add each value in the dictionary deltas to the counter it names."""
+        lift = self.reducer.lift
+        self._write_states(tr, dict((name, lift(x)) for name, x in deltas.iteritems()))
+
+    @fdb.transactional
+    def get(self, tr, name):
+        """Get the value of one counter with snapshot isolation."""
+        return self.get_many(tr, [name])[name]
+
+    @fdb.transactional
+    def get_many(self, tr, names):
+        """
+        Get the values of the named counters with snapshot isolation, as a
+        dictionary, reading them all in one transaction.
+        """
+        names = list(names)
+        ranges = [tr.snapshot[self.subspace.range(_shard_prefix(name))] for name in names]
+        return dict((name, _reduce(self.reducer, shards)) for name, shards in zip(names, ranges))
+
+
+    @fdb.transactional
+    def get_all(self, tr, prefix=()):
+        """
+        Get the values of all counters whose names begin with the tuple
+        prefix with snapshot isolation, as a dictionary, in a single range
+        read.
+        """
+        reducer = self.reducer
+        states = {}
+        for k, v in tr.snapshot[self.subspace.range(prefix)]:
+            name = _name_from_tuple(self.subspace.unpack(k)[:-1])
+            states[name] = reducer.combine(states.get(name, reducer.identity), reducer.decode(v))
+        return dict((name, reducer.result(state)) for name, state in states.iteritems())
+
+    @fdb.transactional
+    def get_total(self, tr, prefix=()):
+        """
+        Get the sum of all counters whose names begin with the tuple prefix
+        with snapshot isolation, in a single range read.
+        """
+        return _reduce(self.reducer, tr.snapshot[self.subspace.range(prefix)])
+
+###############
+# RateCounter #
+###############
+
+class RateCounter:
+    """Counts events in time buckets at several resolutions.
+
+    resolutions is a list of (bucket_seconds, retention_seconds) pairs from
+    finest to coarsest; a retention of None keeps buckets forever. add()
+    writes only to the current bucket of the finest resolution, as a
+    conflict-free shard of a CounterSet named (bucket_seconds, bucket_start).
+
+    maintain() rolls complete fine buckets up into the next coarser
+    resolution, once each bucket is older than lag seconds, and clears
+    buckets older than their retention that have been rolled up. Run it
+    periodically, for example with start_maintenance().
+
+    range() and total() read only the shards of the buckets they cover.
+    A coarse resolution holds buckets only up to its last rollup, so the
+    time after it is read from finer resolutions. Bucket starts are integer
+    seconds since the epoch.
+
+    """
+
+    def __init__(self, db, subspace, resolutions=((1, 3600), (60, 7 * 86400), (3600, None)),
+                 reducer=None, lag=5):
+        self.subspace = subspace
+        self.db = db
+        self.resolutions = list(resolutions)
+        self.lag = lag
+        self.buckets = CounterSet(db, subspace['buckets'], reducer)
+        self.reducer = self.buckets.reducer
+        self._rolled = subspace['rolled']
+        self._stop = threading.Event()
+        self._maintainer = None
+
+    def _bucket_range(self, size, t0, t1):
+        # keys of the buckets of the given size that overlap [t0, t1)
+        first = int(t0) // size * size
+        last = -(-int(math.ceil(t1)) // size) * size
+        s = self.buckets.subspace
+        return s.pack((size, first)), s.pack((size, last))
+
+    @fdb.transactional
+    def add(self, tr, x=1, t=None):
+        """Add x to the bucket containing time t, which defaults to now."""
+        size = self.resolutions[0][0]
+        if t is None:
+            t = time.time()
+        self.buckets._write_states(tr, {(size, int(t) // size * size): self.reducer.lift(x)})
+
+    def _resolution(self, t0):
+        # the finest resolution that still retains time t0
+        now = time.time()
+        for size, retention in self.resolutions:
+            if retention is None or now - retention <= t0:
+                return size
+        return self.resolutions[-1][0]
+
+    def _spans(self, tr, size, t0, t1):
+        # Divide [t0, t1) into (size, t0, t1) spans, reading each resolution
+        # from size down only up to its rollup progress. The finest
+        # resolution is always complete.
+        sizes = [s for s, _ in self.resolutions]
+        spans = []
+        i = sizes.index(size)
+        while i > 0 and t0 < t1:
+            progress = tr.snapshot[self._rolled.pack((sizes[i],))]
+            if progress.present() and _decode_int(progress) > t0:
+                done = _decode_int(progress)
+                spans.append((sizes[i], t0, min(t1, done)))
+                t0 = done
+            i -= 1
+        if t0 < t1:
+            spans.append((sizes[i], t0, t1))
+        return spans
+
+    def _read_spans(self, tr, size, t0, t1):
+        # (bucket size, shards) for each span, with every read issued first
+        return [(s, tr.snapshot[slice(*self._bucket_range(s, b, e))])
+                for s, b, e in self._spans(tr, size, t0, t1)]
+
+    @fdb.transactional
+    def range(self, tr, t0, t1, resolution=None):
+        """
+        Return a list of (bucket_start, value) for the buckets that overlap
+        [t0, t1) and hold data. The resolution is the bucket size to read;
+        by default, the finest one whose retention still covers t0. Time
+        after the resolution's last rollup is returned in finer buckets.
+        """
+        size = resolution or self._resolution(t0)
+        reducer = self.reducer
+        result = []
+        for s, shards in self._read_spans(tr, size, t0, t1):
+            states = {}
+            for k, v in shards:
+                bucket = self.buckets.subspace.unpack(k)[1]
+                states[bucket] = reducer.combine(states.get(bucket, reducer.identity), reducer.decode(v))
+            result.extend((start, reducer.result(states[start])) for start in sorted(states))
+        return result
+
+    @fdb.transactional
+    def total(self, tr, t0, t1, resolution=None):
+        """Return the value over the buckets that overlap [t0, t1)."""
+        size = resolution or self._resolution(t0)
+        reducer = self.reducer
+        state = reducer.identity
+        for s, shards in self._read_spans(tr, size, t0, t1):
+            state = reducer.combine(state, _combine_shards(reducer, shards))
+        return reducer.result(state)
+
+    @fdb.transactional
+    def _rollup(self, tr, fine, coarse, now, limit=100):
+        # Fine buckets other than the finest are complete only up to the
+        # progress of their own rollup
+        complete = now - self.lag
+        if fine != self.resolutions[0][0]:
+            fine_progress = tr[self._rolled.pack((fine,))]
+            if not fine_progress.present():
+                return
+            complete = min(complete, _decode_int(fine_progress))
+
+        # Reading the progress key serializes concurrent rollups
+        progress = tr[self._rolled.pack((coarse,))]
+        if progress.present():
+            start = _decode_int(progress)
+        else:
+            first = tr.snapshot.get_range(self.buckets.subspace.pack((fine,)),
+                                          self.buckets.subspace.range((fine,)).stop, limit=1)
+            first = list(first)
+            if not first:
+                return
+            start = self.buckets.subspace.unpack(first[0].key)[1] // coarse * coarse
+
+        states = {}
+        while start + coarse <= complete and limit > 0:
+            begin, end = self._bucket_range(fine, start, start + coarse)
+            shards = list(tr.snapshot[begin:end])
+            if shards:
+                states[(coarse, start)] = _combine_shards(self.reducer, shards)
+            start += coarse
+            limit -= 1
+        self.buckets._write_states(tr, states)
+        tr[self._rolled.pack((coarse,))] = _encode_int(start)
+
+    @fdb.transactional
+    def _cleanup(self, tr, now):
+        for i, (size, retention) in enumerate(self.resolutions):
+            if retention is None:
+                continue
+            cutoff = int(now - retention) // size * size
+            if i + 1 < len(self.resolutions):
+                # never clear buckets that have not been rolled up
+                progress = tr.snapshot[self._rolled.pack((self.resolutions[i + 1][0],))]
+                if not progress.present():
+                    continue
+                cutoff = min(cutoff, _decode_int(progress))
+            del tr[self.buckets.subspace.pack((size,)):self.buckets.subspace.pack((size, cutoff))]
+
+    def maintain(self):
+        """Roll up complete buckets and clear expired ones."""
+        now = time.time()
+        for (fine, _), (coarse, _) in zip(self.resolutions, self.resolutions[1:]):
+            self._rollup(self.db, fine, coarse, now)
+        self._cleanup(self.db, now)
+
+    def start_maintenance(self, interval=10.0):
+        """Run maintain() every interval seconds in a daemon thread."""
+        self.stop_maintenance()
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.maintain()
+                except fdb.FDBError:
+                    pass # tried again next interval
+        self._stop.clear()
+        self._maintainer = threading.Thread(target=run)
+        self._maintainer.daemon = True
+        self._maintainer.start()
+
+    def stop_maintenance(self):
+        if self._maintainer is not None:
+            self._stop.set()
+            self._maintainer.join()
+            self._maintainer = None
+
+###################
+# IncrementBuffer #
+###################
+
+class IncrementBuffer:
+    """Combines increments to counters in memory and writes them together.
+
+    add() only updates an in-memory sum per counter. A daemon thread writes
+    the sums, one shard per counter and one transaction for all of them,
+    every flush_interval seconds, or sooner once max_pending increments are
+    waiting. Works with Counter, CounterSet and any ShardedAggregate, whose
+    values are combined with its reducer rather than summed.
+
+    Durability: an increment is in the database only once a flush after it
+    has committed, so the increments of up to the last flush_interval
+    seconds (or max_pending increments) are lost if the process crashes.
+    With flush_on_exit, close() is registered to run at normal interpreter
+    exit. Call flush() to make the increments so far durable immediately.
+    add() encodes each value once, so that a value the reducer cannot store
+    fails there rather than in a later flush. If a flush fails with a
+    database error, its increments are kept and retried by the next one;
+    any other error drops them. Errors of the flushing thread are printed
+    to stderr and counted in errors.
+    """
+
+    def __init__(self, db, flush_interval=0.1, max_pending=1000, flush_on_exit=True):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # (counter, name) -> combined state
+        self._count = 0
+        self._wake = threading.Event()
+        self._closed = False
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        if flush_on_exit:
+            import atexit
+            atexit.register(self.close)
+
+    def add(self, counter, x=1, name=None):
+        """Add x to counter, or to the counter name of a CounterSet."""
+        state = counter.reducer.lift(x)
+        counter.reducer.encode(state) # raises if the value cannot be stored
+        with self._lock:
+            self._combine(counter, name, state)
+            self._count += 1
+            if self._count >= self.max_pending:
+                self._wake.set()
+
+    def flush(self):
+        """Write all increments added so far."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._count = 0
+            if not pending:
+                return
+            try:
+                self._write(self.db, pending)
+            except fdb.FDBError:
+                # put the increments back for the next flush
+                with self._lock:
+                    for (counter, name), state in pending.iteritems():
+                        self._combine(counter, name, state)
+                raise
+
+    def _combine(self, counter, name, state):
+        key = (counter, name)
+        if key in self._pending:
+            state = counter.reducer.combine(self._pending[key], state)
+        self._pending[key] = state
+
+    @fdb.transactional
+    def _write(self, tr, pending):
+        sets = {}
+        for (counter, name), state in pending.iteritems():
+            if isinstance(counter, CounterSet):
+                sets.setdefault(counter, {})[name] = state
+            else:
+                counter._write_state(tr, state)
+        for counter_set, states in sets.iteritems():
+            counter_set._write_states(tr, states)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except fdb.FDBError:
+                pass # retried by the next flush
+            except Exception:
+                # the increments were dropped; the thread must keep running
+                self.errors += 1
+                traceback.print_exc()
+
+    def close(self):
+        """Stop the flushing thread and write any remaining increments."""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+
+#############
+# Coalescer #
+#############
+
+class Coalescer:
+    """Merges the shards of a Counter or CounterSet in the background.
+
+    Whenever the counter has more than target_shards shards, the coalescer
+    merges up to batch shards per transaction, running at most rate
+    transactions per second and waiting for each to commit. Otherwise it
+    checks the shard count every interval seconds.
+
+    In 'thread' mode the coalescer runs in a daemon thread of this process.
+    In 'process' mode it runs as a separate process executing this module,
+    which opens the database from cluster_file. The counter's reducer is
+    passed to that process pickled, so it must be picklable and its class
+    importable there.
+    """
+
+    def __init__(self, counter, target_shards=20, batch=20, rate=10.0,
+                 interval=1.0, mode='thread', cluster_file=None):
+        if mode not in ('thread', 'process'):
+            raise ValueError("mode must be 'thread' or 'process'")
+        self.counter = counter
+        self.target_shards = target_shards
+        self.batch = batch
+        self.rate = rate
+        self.interval = interval
+        self.mode = mode
+        self.cluster_file = cluster_file
+        self.merged = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._worker = None
+
+    def step(self):
+        """Merge one batch of shards if there are too many. Returns the number merged."""
+        excess = self.counter.count_shards(self.target_shards + self.batch) - self.target_shards
+        if excess <= 0:
+            return 0
+        tr = self.counter.db.create_transaction()
+        try:
+            merged = self.counter._merge_shards(tr, min(self.batch, excess + 1))
+            tr.commit().wait()
+        except fdb.FDBError:
+            # another coalescer merged the same shards; try elsewhere next time
+            self.errors += 1
+            return 0
+        self.merged += merged
+        return merged
+
+    def run(self):
+        """Coalesce until stop() is called."""
+        while not self._stop.is_set():
+            if self.step():
+                self._stop.wait(1.0 / self.rate)
+            else:
+                self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        if self.mode == 'thread':
+            self._worker = threading.Thread(target=self.run)
+            self._worker.daemon = True
+            self._worker.start()
+        else:
+            import subprocess
+            args = [sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + '.py',
+                    'coalesce', self.counter.subspace.key().encode('hex'),
+                    '--target-shards', str(self.target_shards),
+                    '--batch', str(self.batch), '--rate', str(self.rate),
+                    '--interval', str(self.interval)]
+            if self.cluster_file:
+                args += ['--cluster-file', self.cluster_file]
+            if isinstance(self.counter, CounterSet):
+                args += ['--set']
+            args += ['--reducer', pickle.dumps(self.counter.reducer, 2).encode('hex')]
+            self._worker = subprocess.Popen(args)
+
+    def stop(self):
+        self._stop.set()
+        if self._worker is None:
+            return
+        if self.mode == 'thread':
+            self._worker.join()
+        else:
+            self._worker.terminate()
+            self._worker.wait()
+        self._worker = None
+
+def _coalesce_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description='Coalesce the shards of a Counter.')
+    parser.add_argument('prefix', help='hex-encoded key prefix of the counter')
+    parser.add_argument('--cluster-file', default=None)
+    parser.add_argument('--target-shards', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=10.0)
+    parser.add_argument('--interval', type=float, default=1.0)
+    parser.add_argument('--set', action='store_true', help='the prefix is of a CounterSet')
+    parser.add_argument('--reducer', default=None,
+                        help='hex-encoded pickle of the reducer; default is IntSum')
+    args = parser.parse_args(argv)
+
+    db = fdb.open(args.cluster_file)
+    subspace = Subspace(rawPrefix=args.prefix.decode('hex'))
+    reducer = pickle.loads(args.reducer.decode('hex')) if args.reducer else IntSum()
+    if args.set:
+        counter = CounterSet(db, subspace, reducer)
+    else:
+        counter = ShardedAggregate(db, subspace, reducer)
+    Coalescer(counter, args.target_shards, args.batch, args.rate, args.interval).run()
+
 ##################
 # simple example #
 ##################
@@ -154,7 +1004,69 @@ def counter_example_2(db, location):
 
     print c.get_snapshot(db) #500
 
-if __name__ == "__main__":
+######################
+# CounterSet example #
+######################
+
+def counter_set_example(db, location):
+    cs = CounterSet(db, location)
+
+    for i in range(100):
+        cs.add(db, {('tenant1', 'get'): 1, ('tenant1', 'put'): 2, ('tenant2', 'get'): 1})
+    print cs.get_many(db, [('tenant1', 'get'), ('tenant2', 'get')]) # 100 each
+    print cs.get_total(db, ('tenant1',)) #300
+
+#######################
+# RateCounter example #
+#######################
+
+def rate_counter_example(db, location):
+    rc = RateCounter(db, location, resolutions=[(1, 600), (60, 86400)], lag=0)
+
+    now = int(time.time()) // 60 * 60
+    for i in range(120):
+        rc.add(db, 1, now - 120 + i) # one event per second for two minutes
+    rc.maintain()
+    print rc.range(db, now - 120, now, resolution=60) # two buckets of 60
+    print rc.total(db, now - 30, now) #30
+
+#############
+# benchmark #
+#############
+
+def counter_benchmark(db, location, threads=50, n=10, backends=('sharded', 'atomic', 'hybrid')):
+    """
+    Run the workload of counter_example_2 against each backend in turn and
+    print the time taken, the rate of increments and the final value.
+    """
+    import threading
+
+    results = {}
+    for backend in backends:
+        del db[location.range()]
+        c = Counter(db, location, backend=backend)
+
+        workers = [
+            threading.Thread(target=incrementer_thread, args=(c, db, n))
+            for i in range(threads)]
+        start = time.time()
+        for thr in workers: thr.start()
+        for thr in workers: thr.join()
+        elapsed = time.time() - start
+
+        value = c.get_snapshot(db)
+        keys = c.count_shards()
+        results[backend] = (elapsed, threads * n / elapsed, value, keys)
+        print "%-8s %7.3f s %9.0f adds/s value %d keys %d" % ((backend,) + results[backend])
+    return results
+
+if __name__ == "__main__" and sys.argv[1:2] == ['coalesce']:
+    _coalesce_main(sys.argv[2:])
+elif __name__ == "__main__" and sys.argv[1:2] == ['benchmark']:
+    db = fdb.open()
+    location = directory.create_or_open( db, ('tests','counter_benchmark') )
+    counter_benchmark(db, location, *[int(a) for a in sys.argv[2:4]])
+elif __name__ == "__main__":
     db = fdb.open()
     location = directory.create_or_open( db, ('tests','counter') )
     del db[location.range()]
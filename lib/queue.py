@@ -11,10 +11,14 @@ popping clients.
 If high contention mode is off, then no attempt will be made to avoid
 transaction conflicts in pop operations. This mode performs well with
 only one popping client, but will not scale well to many popping clients.
+
+In either mode, push_many() and pop_many() move a batch of items in a single
+transaction, so a batch costs about as much as a single push or pop.
 """
 
 import time
 import os
+import itertools
 
 import fdb
 import fdb.tuple
@@ -27,6 +31,12 @@ fdb.api_version(100)
 #########
 
 class Queue:
+    # Most items a single pop_many() call will pop, and most items one
+    # transaction will hand out while fulfilling waiting batch pops. These
+    # keep every transaction well inside the size and time limits.
+    maxPopBatch = 1000
+    maxFulfillItems = 1000
+
     # Public functions
     def __init__(self, subspace, highContention=True):
         self.subspace = subspace
@@ -47,6 +57,15 @@ class Queue:
         index = self._getNextIndex(tr.snapshot, self._queueItem)
         self._pushAt(tr, self._encodeValue(value), index)
 
+    @fdb.transactional
+    def push_many(self, tr, values):
+        """Push a list of items onto the queue, in order, at a single index."""
+        values = list(values)
+        if not values:
+            return
+        index = self._getNextIndex(tr.snapshot, self._queueItem)
+        self._pushManyAt(tr, [self._encodeValue(v) for v in values], index)
+
     def pop(self, db):
         """Pop the next item from the queue. Cannot be composed with other functions in a single transaction."""
 
@@ -60,6 +79,21 @@ class Queue:
 
         return self._decodeValue(result)
 
+    def pop_many(self, db, n):
+        """Pop up to n items from the queue, returning a list that is empty if the queue is. At most maxPopBatch items are popped per call. Cannot be composed with other functions in a single transaction."""
+
+        if n <= 0:
+            return []
+
+        n = min(n, self.maxPopBatch)
+
+        if self.highContention:
+            results = self._popHighContention(db, n)
+        else:
+            results = self._popSimpleMany(db, n)
+
+        return [self._decodeValue(v) for v in results]
+
     @fdb.transactional
     def empty(self, tr):
         """Test whether the queue is empty."""
@@ -97,6 +131,15 @@ class Queue:
         read = tr[key]
         tr[key] = value
 
+    # A batch shares one index and one random ID, with its position appended so
+    # that the batch keeps its order. Reading the first key is enough to make
+    # a colliding batch conflict.
+    def _pushManyAt(self, tr, values, index):
+        batchID = self._randID()
+        read = tr[self._queueItem.pack((index, batchID, 0))]
+        for i, value in enumerate(values):
+            tr[self._queueItem.pack((index, batchID, i))] = value
+
     def _getNextIndex(self, tr, subspace):
         lastKey = tr.get_key(fdb.KeySelector.last_less_than(subspace.range().stop))
         if lastKey < subspace.range().start:
@@ -122,9 +165,22 @@ class Queue:
 
         del tr[firstItem.key]
         return firstItem.value
-        
+
+    @fdb.transactional
+    def _popSimpleMany(self, tr, numItems):
+        items = list(self._getItems(tr, numItems))
+        if not items:
+            return []
+
+        # The range read conflicts with anything pushed before the last item
+        del tr[self._queueItem.range().start : items[-1].key + '\x00']
+        return [kv.value for kv in items]
+
+    # A waiting pop is stored with an empty value if it wants a single item, or
+    # with the number of items it wants. The items for a single pop are stored
+    # at its random ID and those for a batch at (random ID, position).
     @fdb.transactional
-    def _addConflictedPop(self, tr, forced=False):
+    def _addConflictedPop(self, tr, forced=False, count=None):
         index = self._getNextIndex(tr.snapshot, self._conflictedPop)
 
         if index == 0 and not forced:
@@ -132,8 +188,11 @@ class Queue:
 
         waitKey = self._conflictedPop.pack((index, self._randID()))
         read = tr[waitKey]
-        tr[waitKey] = ''
+        tr[waitKey] = '' if count is None else fdb.tuple.pack((count,))
         return waitKey
+
+    def _popCount(self, value):
+        return min(fdb.tuple.unpack(value)[0], self.maxPopBatch) if value else 1
         
     def _getWaitingPops(self, tr, numPops):
         r = self._conflictedPop.range()
@@ -147,33 +206,47 @@ class Queue:
         numPops = 100
 
         tr = db.create_transaction()
-        pops = self._getWaitingPops(tr.snapshot, numPops)
-        items = self._getItems(tr.snapshot, numPops)
-
-        i = 0
-        pops = list(pops)
-        for pop,(k,v) in zip(pops, items):
+        pops = list(self._getWaitingPops(tr.snapshot, numPops))
+        if not pops:
+            return True
+
+        # Serve waiting pops in order until the transaction would hand out
+        # more than maxFulfillItems; the rest stay waiting for the next round
+        done = len(pops) < numPops
+        numItems = 0
+        for i, pop in enumerate(pops):
+            if i > 0 and numItems + self._popCount(pop.value) > self.maxFulfillItems:
+                pops = pops[:i]
+                done = False
+                break
+            numItems += self._popCount(pop.value)
+
+        items = iter(self._getItems(tr.snapshot, numItems))
+
+        for pop in pops:
             key = self._conflictedPop.unpack(pop.key)
-            storageKey = self._conflictedItemKey(key[1])
-            tr[storageKey] = v
-            read = tr[k]
-            read = tr[pop.key]
-            del tr[pop.key]
-            del tr[k]
-            i = i + 1
-
-        for pop in pops[i:]:
+            for j,(k,v) in enumerate(itertools.islice(items, self._popCount(pop.value))):
+                if pop.value:
+                    storageKey = self._conflictedItem.pack((key[1], j))
+                else:
+                    storageKey = self._conflictedItemKey(key[1])
+                tr[storageKey] = v
+                read = tr[k]
+                del tr[k]
+
+            # Pops left without items are fulfilled with whatever they got
             read = tr[pop.key]
             del tr[pop.key]
 
         tr.commit().wait()
-        return len(pops) < numPops
+        return done
 
     # This implementation of pop attempts to avoid collisions by registering
     # itself in a semi-ordered set of poppers if it doesn't initially succeed. 
     # It then enters a polling loop where it attempts to fulfill outstanding pops
-    # and then checks to see if it has been fulfilled.
-    def _popHighContention(self, db):
+    # and then checks to see if it has been fulfilled. If count is given, up
+    # to count items are popped at once and returned as a list.
+    def _popHighContention(self, db, count=None):
 
         backoff = 0.01
 
@@ -182,10 +255,13 @@ class Queue:
         try:
             # Check if there are other people waiting to be popped. If so, we
             # cannot pop before them.
-            waitKey = self._addConflictedPop(tr)
+            waitKey = self._addConflictedPop(tr, count=count)
             if waitKey is None:
                 # No one else was waiting to be popped
-                item = self._popSimple(tr)
+                if count is None:
+                    item = self._popSimple(tr)
+                else:
+                    item = self._popSimpleMany(tr, count)
                 tr.commit().wait()
                 return item
             else:
@@ -193,10 +269,12 @@ class Queue:
 
         except fdb.FDBError as e:
             # If we didn't succeed, then register our pop request
-            waitKey = self._addConflictedPop(db, True)
+            waitKey = self._addConflictedPop(db, True, count)
 
-        # The result of the pop will be stored at this key once it has been fulfilled
+        # The result of the pop will be stored at this key (or in this range,
+        # for a batch) once it has been fulfilled
         resultKey = self._conflictedItemKey(self._conflictedPop.unpack(waitKey)[1])
+        resultRange = self._conflictedItem.range((self._conflictedPop.unpack(waitKey)[1],))
 
         tr.reset()
 
@@ -226,6 +304,12 @@ class Queue:
                     backoff = min(1, backoff * 2)
                     continue
 
+                if count is not None:
+                    results = [kv.value for kv in tr.get_range(resultRange.start, resultRange.stop)]
+                    del tr[resultRange.start : resultRange.stop]
+                    tr.commit().wait()
+                    return results
+
                 if not result.present():
                     return None
 
@@ -257,6 +341,9 @@ def queue_test(db):
     print 'Empty? %s' % queue.empty(db)
     print 'Push 5'
     queue.push(db, 5)
+    print 'Push many 4, 3, 2'
+    queue.push_many(db, [4, 3, 2])
+    print 'Pop many: %s' % queue.pop_many(db, 3)
     print 'Clear Queue'
     queue.clear(db)
     print 'Empty? %s' % queue.empty(db)
@@ -286,9 +373,20 @@ def pop_thread(queue, db, id, num):
 
     print 'Finished pop thread %d' % id
 
+def push_many_thread(queue, db, id, num, batch):
+    for i in range(0, num, batch):
+        queue.push_many(db, ['%d.%d' % (id, j) for j in range(i, min(i + batch, num))])
+
+def pop_many_thread(queue, db, id, num, batch):
+    popped = 0
+    while popped < num:
+        popped += len(queue.pop_many(db, min(batch, num - popped)))
+
+    print 'Finished pop thread %d' % id
+
 import threading
 
-def queue_multi_client_example(db):
+def queue_multi_client_example(db, batch=None):
     descriptions = ["simple queue", "high contention queue"]
 
     for highContention in range(2):
@@ -296,8 +394,12 @@ def queue_multi_client_example(db):
         queue = Queue(directory.create_or_open(db, ('tests','queue')), highContention > 0)
         queue.clear(db)
 
-        pushThreads = [ threading.Thread(target=push_thread, args=(queue, db, i, 100)) for i in range(10) ]
-        popThreads = [ threading.Thread(target=pop_thread, args=(queue, db, i, 100)) for i in range(10) ]
+        if batch is None:
+            pushThreads = [ threading.Thread(target=push_thread, args=(queue, db, i, 100)) for i in range(10) ]
+            popThreads = [ threading.Thread(target=pop_thread, args=(queue, db, i, 100)) for i in range(10) ]
+        else:
+            pushThreads = [ threading.Thread(target=push_many_thread, args=(queue, db, i, 100, batch)) for i in range(10) ]
+            popThreads = [ threading.Thread(target=pop_many_thread, args=(queue, db, i, 100, batch)) for i in range(10) ]
 
         start = time.time()
         
@@ -316,6 +418,9 @@ def queue_example(db):
     print "\nRunning multi-client example:"
     queue_multi_client_example(db)
 
+    print "\nRunning multi-client example in batches of 10:"
+    queue_multi_client_example(db, 10)
+
 # caution: modifies the database!
 if __name__ == '__main__':
     db = fdb.open()
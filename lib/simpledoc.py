@@ -511,7 +511,15 @@ class Index (Plugin):
     indexes will stay in sync with the corresponding data.
 
     Indexes are stored in a special document off the root document.
+
+    Setting deferred to True stops an index from being maintained, which lets
+    bulk loads write documents without reading old values. While deferred,
+    the index is out of date and must not be used. It is made consistent
+    again by clearing it and calling backfill() for every stored value within
+    scan_range() whose path matches().
     """
+    registered = []
+
     def __init__(self, docPath, keyPath):
         docPath = ["d"] + docPath.split(".")
         if keyPath:
@@ -525,12 +533,19 @@ class Index (Plugin):
         self.key_keys = tuple(i+len(docPath) for i, k in enumerate(keyPath) if k == '?')
         self.register(self.dkPath)
         self.index_doc = root.index[str(self.plugin_id)]
+        self.deferred = False
+        Index.registered.append(self)
 
     def set_value(self, node, value):
-        self.update_index_if_required(node, value)
+        if not self.deferred:
+            self.update_index_if_required(node, value)
         node.set_value(value)
 
     def clear_subtree(self, node):
+        if self.deferred:
+            node.clear_all()
+            return
+
         depth = len(node._path)
 
         # Identify any wildcards in self.dkPath that haven't been filled in by node._path
@@ -572,6 +587,24 @@ class Index (Plugin):
     def update_index(self, docKey, oldValue, newValue):
         pass
 
+    def matches(self, path):
+        if len(path) != len(self.dkPath):
+            return False
+        return all(k == '?' or k == p for k, p in zip(self.dkPath, path))
+
+    def scan_range(self):
+        # Keys of all values that may be indexed, from the fixed part of dkPath
+        prefix = []
+        for k in self.dkPath:
+            if k == '?': break
+            prefix.append(k)
+        prefix = tuple(prefix)
+        return slice(fdb.tuple.pack(prefix), fdb.tuple.range(prefix).stop)
+
+    def backfill(self, node, value):
+        path = [node._path[i] for i in self.key_keys+self.index_keys]
+        self.update_index(path, None, value)
+
 
 ################
 # OrderedIndex #
@@ -715,6 +748,9 @@ class KeyIndex (OrderedIndex):
         else:
             self.index_doc.get_descendant(path).set_value(None)
 
+    def backfill(self, node, value):
+        self.update_index_if_required(node, value)
+
 
 ###########################
 # SimpleDoc Example Usage #